@@ -1,73 +1,83 @@
 import argparse
-import tkinter as tk
-from tkinter.filedialog import askopenfilename
+import cli_prompts
 from pathlib import Path
-import matplotlib.pyplot as plt
-from tqdm import tqdm
-import fnmatch
 import pandas as pd
 from multiprocessing import pool
 import functools
-import numpy as np
+import json
+from tqdm import tqdm
+import index_zip_folder
+import copdgene_data
 
 """
 Script to analyse copdgene subject dataset zip index
 """
 
+# index_zip_folder's subject, inex and phase patterns (the phase taking the last match) rewritten for the RE2 engine
+# of Arrow strings, which has no lookahead, so whole columns are matched without a Python call per value
+subject_pattern = r"^(?P<subject>\d{5}[A-Z])(?:[_.]|$)"
+inex_pattern = r"_(?P<inex>INSP|EXP)(?:[_.]|$)"
+phase_pattern = r"^(?:.*/)?(?P<phase>COPD\d)(?:/|$)"
+# Fallbacks for files such as DICOM slices that only carry the subject and inex in their directory
+path_subject_pattern = r"(?:^|/)(?P<subject>\d{5}[A-Z])(?:[_./]|$)"
+path_inex_pattern = r"_(?P<inex>INSP|EXP)(?:[_./]|$)"
+
+# Artifact types of the coverage matrix, by file name suffix
+default_artifacts = {"zip": ".zip", "lobes": "Lobes.mhd", "ct": ".dcm"}
+coverage_keys = ["subject", "artifact", "phase", "inex"]
+
 
 def run_cli():
     output_directory = Path("output")
 
-    search_phase = "COPD1"
-    search_inex = "EXP"
-
     parser = argparse.ArgumentParser()
-    parser.add_argument("--data_file", help="Subject data file for COPDGene dataset", type=str)
+    parser.add_argument("--data_file", help="Directory index of the COPDGene dataset written by "
+                        "index_zip_folder, in tsv, parquet or sqlite format", type=str)
+    parser.add_argument("--artifacts", help="Artifact types of the coverage matrix as name=file name suffix",
+                        nargs="+", type=str, default=[f"{name}={suffix}" for name, suffix in default_artifacts.items()])
+    parser.add_argument("--artifact", help="Artifact type to count per subject", type=str, default="lobes")
+    parser.add_argument("--phase", help="Phase to count per subject, or any", type=str, default="COPD1")
+    parser.add_argument("--inex", help="INSP or EXP to count per subject, or any", type=str, default="EXP")
+    parser.add_argument("--chunk_rows", help="Index rows per parallel chunk", type=int, default=100000)
+    parser.add_argument("--rebuild", help="Rebuild the coverage even if the cached one is up to date",
+                        action="store_true")
+    cli_prompts.add_interactive_argument(parser)
     args = parser.parse_args()
 
     if args.data_file is not None:
         data_file = args.data_file
     else:
-        tk.Tk().withdraw()
-        if not (data_file := askopenfilename(title="Select dataset zip index file")):
+        if not cli_prompts.is_interactive(args):
+            parser.error("--data_file is required when not interactive")
+        if not (data_file := cli_prompts.ask_open_filename("Select dataset zip index file")):
             exit()
 
-    data = pd.read_csv(data_file, sep="\t")
+    artifacts = dict(a.split("=", 1) for a in args.artifacts)
+    if args.artifact not in artifacts:
+        parser.error(f"--artifact must be one of {', '.join(artifacts)}")
 
-    mpool = pool.Pool()
+    output_directory.mkdir(exist_ok=True)
+    cache_path = copdgene_data.cache_file(data_file, output_directory, "-coverage.parquet")
+    coverage = load_coverage(cache_path, data_file, artifacts) if not args.rebuild else None
+    if coverage is None:
+        with pool.Pool() as mpool:
+            coverage = build_coverage(data_file, artifacts, mpool, chunk_rows=args.chunk_rows)
+        save_coverage(coverage, cache_path, data_file, artifacts)
 
-    # filter = list(tqdm(mpool.imap(any_zips_or_lobes, data["files"]), desc="Filtering data", total=len(data["files"])))
-    # data = data[filter]
-    # data.to_csv(str(output_directory / f"{Path(data_file).stem}_filtered.csv"), sep="\t")
+    matrix = coverage_matrix(coverage)
+    matrix.to_csv(str(output_directory / "coverage_matrix.csv"))
+    print("Subjects with each artifact:")
+    print((matrix > 0).sum().to_string())
 
-    # Get all subjects
-    # subjects = list(
-    #     tqdm(mpool.imap(find_subjects, data["files"]), desc="Finding all subjects", total=len(data["files"])))
-    subjects = list(
-        tqdm([find_subjects(files) for files in data["files"]], desc="Finding all subjects", total=len(data["files"])))
-    unique_subjects = list(set(flatten(subjects)))
-    subject_dict = {s: 0 for s in unique_subjects}
-
-    # subjects_segmentations = list(
-    #     tqdm(mpool.imap(find_lobe_segmentations, data["files"]), desc="Finding subjects with lobe segmentations",
-    #          total=len(data["files"])))
-    subjects_segmentations = list(
-        tqdm([find_lobe_segmentations((files, dirpath, search_phase, search_inex)) for files, dirpath in
-              zip(data["files"], data["dirpath"])], desc="Finding subjects with lobe segmentations",
-             total=len(data["files"])))
-    unique, counts = np.unique(flatten(subjects_segmentations), return_counts=True)
-
-    for unique, counts in zip(unique, counts):
-        subject_dict[unique] = counts
-
-    subject_dict_df = pd.DataFrame.from_dict(subject_dict, orient="index")
+    subject_dict_df = pd.DataFrame({0: select_coverage(matrix, args.artifact, none_if_any(args.phase),
+                                                       none_if_any(args.inex))}).rename_axis(None)
     print(subject_dict_df.value_counts())
 
     subject_dict_df.to_csv(str(output_directory / "subject_dict_df.csv"))
 
 
-def flatten(l):
-    return [item for sublist in l for item in sublist]
+def none_if_any(value):
+    return None if value == "any" else value
 
 
 def args_unpacker(func):
@@ -80,41 +90,190 @@ def args_unpacker(func):
     return unpack
 
 
-def any_zips_or_lobes(files):
-    match = False
-    files = files.split("'")
-    if len(fnmatch.filter(files, "*.zip")) > 0 or len(fnmatch.filter(files, "*Lobes.mhd")) > 0:
-        match = True
+def explode_files(data):
+    """
+    Turn a per directory index, whose files column holds stringified lists of file names, into one row per file.
+    The lists are split as Arrow strings in one vectorised pass, so no Python list is built per row. repr quotes a name
+    holding ' with ", so either quote is accepted around each name, but a name holding both quotes or a backslash keeps
+    the escapes repr added
+
+    Parameters
+    ----------
+    data
+        DataFrame with dirpath and files columns
 
-    return match
+    Returns
+    -------
+    files
+        DataFrame with dirpath and name columns
+    """
+    # "['a.zip', \"b'c.txt\"]" -> ["a.zip", "b'c.txt"], and "[]" -> [""]
+    names = arrow_strings(data["files"]).str.slice(2, -2).str.split(r"""['"], ['"]""", regex=True)
+    files = pd.DataFrame({"dirpath": data["dirpath"], "name": names}).explode("name", ignore_index=True)
+    return files[files["name"].fillna("") != ""].reset_index(drop=True)
 
 
-def find_subjects(files):
-    subjects = []
-    files = files.split("'")
-    if len(zip_files := fnmatch.filter(files, "*.zip")) > 0:
-        for file in zip_files:
-            subject = file.strip(".zip")
-            subjects.append(subject)
+def arrow_strings(column):
+    import pyarrow as pa
+    return column.astype(pd.ArrowDtype(pa.string()))
 
-    return subjects
+
+def build_coverage(data_file, artifacts, mpool=None, chunk_rows=100000):
+    """
+    Count the files of every subject, phase, INSP/EXP and artifact type in one pass over a directory index. The
+    index is read in chunks that are classified in parallel
+
+    Parameters
+    ----------
+    data_file
+        .csv (tsv), .parquet or .sqlite index written by index_zip_folder
+    artifacts
+        Dict of artifact type to file name suffix, e.g. {"lobes": "Lobes.mhd"}. Files matching none are ignored
+    mpool
+        Pool to classify chunks in, or None to classify them in this process
+    chunk_rows
+        Index rows per chunk
+
+    Returns
+    -------
+    coverage
+        DataFrame with subject, artifact, phase, inex and files columns. Phase and inex are "" where the file does
+        not have one, e.g. for subject zips
+    """
+    chunks = ((chunk, artifacts) for chunk in read_index_chunks(data_file, chunk_rows))
+    imap = mpool.imap_unordered if mpool is not None else map
+    counts = [c for c in tqdm(imap(classify_chunk, chunks), desc="Classifying index chunks") if len(c) > 0]
+    if not counts:
+        return pd.DataFrame(columns=coverage_keys + ["files"])
+    return pd.concat(counts).groupby(level=coverage_keys).sum().rename("files").reset_index()
+
+
+def read_index_chunks(data_file, chunk_rows):
+    """
+    Read a directory index in chunks of rows. TSV chunks have dirpath and files columns, and parquet and SQLite
+    chunks have dirpath and name columns
+    """
+    suffix = Path(data_file).suffix
+    if suffix == ".parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(data_file).iter_batches(batch_size=chunk_rows, columns=["dirpath", "name"]):
+            yield batch.to_pandas()
+    elif suffix == ".sqlite":
+        files = index_zip_folder.query_sqlite_index(data_file, columns=["dirpath", "name"])
+        for start in range(0, len(files), chunk_rows):
+            yield files.iloc[start:start + chunk_rows]
+    else:
+        yield from pd.read_csv(data_file, sep="\t", usecols=["dirpath", "files"], chunksize=chunk_rows)
 
 
 @args_unpacker
-def find_lobe_segmentations(files, dirpath, search_phase, search_inex):
-    subjects = []
-    files = files.split("'")
-    if len(lobe_files := fnmatch.filter(files, "*Lobes.mhd")) > 0:
-        for file in lobe_files:
-            subject = file.split("_")[0]
-            phase = Path(dirpath).parents[0].name
-            inex = file.split("_")[1]
-            if search_phase is not None and phase != search_phase:
-                continue
-            if search_inex is not None and inex != search_inex:
-                continue
-            subjects.append(subject)
-    return subjects
+def classify_chunk(chunk, artifacts):
+    """
+    Count the files of a chunk of the index by subject, artifact, phase and inex
+
+    Parameters
+    ----------
+    chunk
+        Chunk from read_index_chunks
+    artifacts
+        Dict of artifact type to file name suffix
+
+    Returns
+    -------
+    counts
+        Series of file counts indexed by subject, artifact, phase and inex
+    """
+    files = explode_files(chunk) if "files" in chunk.columns else chunk
+    names = arrow_strings(files["name"])
+    dirpaths = arrow_strings(files["dirpath"])
+
+    artifact = pd.Series(pd.NA, index=names.index, dtype=names.dtype)
+    for name, suffix in reversed(artifacts.items()):
+        artifact = artifact.mask(names.str.endswith(suffix), name)
+    keep = artifact.notna().to_numpy()
+    names, dirpaths, artifact = names[keep], dirpaths[keep], artifact[keep]
+
+    # Parse each distinct directory once
+    codes, unique_dirpaths = pd.factorize(dirpaths)
+    unique_dirpaths = pd.Series(unique_dirpaths)
+
+    def from_dirpath(pattern):
+        parsed = unique_dirpaths.str.extract(pattern, expand=False).to_numpy()[codes]
+        return pd.Series(parsed, index=names.index, dtype=names.dtype)
+
+    subject = names.str.extract(subject_pattern, expand=False).fillna(from_dirpath(path_subject_pattern))
+    inex = names.str.extract(inex_pattern, expand=False).fillna(from_dirpath(path_inex_pattern))
+    phase = from_dirpath(phase_pattern)
+
+    classified = pd.DataFrame({"subject": subject, "artifact": artifact, "phase": phase.fillna(""),
+                               "inex": inex.fillna("")})
+    return classified[classified["subject"].notna()].groupby(coverage_keys, observed=True).size()
+
+
+def coverage_matrix(coverage):
+    """
+    Pivot the coverage into one row per subject and one column per artifact, phase and inex, holding file counts
+    """
+    matrix = coverage.pivot_table(index="subject", columns=["artifact", "phase", "inex"], values="files",
+                                  aggfunc="sum", fill_value=0)
+    return matrix.sort_index(axis=1)
+
+
+def select_coverage(matrix, artifact, phase=None, inex=None):
+    """
+    File counts of one artifact per subject, over every subject in the matrix
+
+    Parameters
+    ----------
+    matrix
+        From coverage_matrix
+    artifact
+    phase
+        e.g. COPD1, or None for any phase
+    inex
+        INSP or EXP, or None for both
+
+    Returns
+    -------
+    counts
+        Series of file counts indexed by subject
+    """
+    columns = matrix.columns
+    select = columns.get_level_values("artifact") == artifact
+    if phase is not None:
+        select &= columns.get_level_values("phase") == phase
+    if inex is not None:
+        select &= columns.get_level_values("inex") == inex
+    return matrix.loc[:, select].sum(axis=1)
+
+
+def coverage_key(data_file, artifacts):
+    stat = Path(data_file).stat()
+    return {"index": str(Path(data_file).absolute()), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "artifacts": artifacts}
+
+
+def load_coverage(cache_path, data_file, artifacts):
+    """
+    Load a cached coverage if it was built from the index as it is now and with the same artifact types, otherwise
+    return None
+    """
+    if not Path(cache_path).exists():
+        return None
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(cache_path).metadata or {}
+    if json.loads(metadata.get(b"coverage_key", b"null")) != coverage_key(data_file, artifacts):
+        return None
+    return pd.read_parquet(cache_path)
+
+
+def save_coverage(coverage, cache_path, data_file, artifacts):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(coverage, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b"coverage_key": json.dumps(coverage_key(data_file, artifacts))})
+    pq.write_table(table, cache_path)
 
 
 if __name__ == "__main__":
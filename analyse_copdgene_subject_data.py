@@ -1,15 +1,25 @@
 import argparse
-import tkinter as tk
-from tkinter.filedialog import askopenfilename
+import cli_prompts
+import copdgene_data
+import subject_cube
 from pathlib import Path
-import matplotlib.pyplot as plt
+from multiprocessing import pool
+from tqdm import tqdm
 
+import numpy as np
 import pandas as pd
 
 """
 Script to analyse copdgene subject data
 """
 
+count_columns = ["finalgold_baseline", "race", "gender"]
+histogram_columns = ["age_baseline", "Height_CM", "Weight_KG"]
+subject_columns = ["race", "finalgold_baseline", "gender", "age_baseline", "Height_CM", "Weight_KG"]
+bin_width = 2.5
+cube_dimensions = count_columns + histogram_columns
+cube_bin_widths = {column: bin_width for column in histogram_columns}
+
 
 def run_cli():
     output_directory = Path("output")
@@ -20,7 +30,23 @@ def run_cli():
     parser.add_argument("--use_subject_list", help="Use sub list of subjects", default=False,
                         action=argparse.BooleanOptionalAction)
     parser.add_argument("--subject_list", help="List of subjects to analyse", type=str)
+    parser.add_argument("--subject_lists", help="Lists of subjects to analyse in one batch, writing a figure for each "
+                                                "list to --figure_directory instead of showing it", nargs="+", type=str)
+    parser.add_argument("--figure_directory", help="Directory for the figures of --subject_lists", type=str,
+                        default=str(output_directory / "figures"))
+    parser.add_argument("--workers", help="Number of processes rendering figures", type=int, default=None)
+    parser.add_argument("--query", help="Filters of a query answered from the aggregate cube, as column=value, "
+                                        "column=value,value or column=low:high for age, height and weight, e.g. "
+                                        "gender=Female age_baseline=60:70", nargs="+", type=str)
+    parser.add_argument("--query_by", help="Column to print the distribution of over the subjects matching --query, "
+                                           "instead of drawing the figure", type=str)
+    parser.add_argument("--cache", help="Cache the parsed data file and data dict so later runs load quickly",
+                        default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--cache_directory", help="Directory of the cache", type=str,
+                        default=str(copdgene_data.default_cache_directory))
+    cli_prompts.add_interactive_argument(parser)
     args = parser.parse_args()
+    interactive = cli_prompts.is_interactive(args)
 
     use_subject_list = False
     if args.subject_list is not None and args.use_subject_list:
@@ -29,90 +55,216 @@ def run_cli():
     if args.data_file is not None:
         data_file = args.data_file
     else:
-        tk.Tk().withdraw()
-        if not (data_file := askopenfilename(title="Select subject data file")):
+        if not interactive:
+            parser.error("--data_file is required when not interactive")
+        if not (data_file := cli_prompts.ask_open_filename("Select subject data file")):
             exit()
 
     if args.data_dict is not None:
         data_dict_file = args.data_dict
     else:
-        tk.Tk().withdraw()
-        if not (data_dict_file := askopenfilename(title="Select subject data file")):
+        if not interactive:
+            parser.error("--data_dict is required when not interactive")
+        if not (data_dict_file := cli_prompts.ask_open_filename("Select subject data file")):
             exit()
 
     if use_subject_list and args.subject_list is not None:
         subject_list_file = args.subject_list
         subject_list = pd.read_csv(subject_list_file)
     elif use_subject_list:
-        tk.Tk().withdraw()
-        if not (subject_list_file := askopenfilename(title="Select subject list file")):
+        if not interactive:
+            parser.error("--subject_list is required when not interactive")
+        if not (subject_list_file := cli_prompts.ask_open_filename("Select subject list file")):
             exit()
         subject_list = pd.read_csv(subject_list_file)
 
-    data = pd.read_csv(data_file, sep="\t")
+    cache_directory = args.cache_directory if args.cache else None
+    data_dict = copdgene_data.read_data_dictionary(data_dict_file, cache_directory=cache_directory)
+    units = {column: data_dict["Units"].get(column) for column in histogram_columns}
+    dictionary = copdgene_data.DataDictionary(data_dict)
+
+    def read_rows(sids):
+        # Decode race, gold stage and gender to their labels
+        return dictionary.decode_frame(copdgene_data.read_subject_data(data_file, columns=subject_columns, sids=sids,
+                                                                       cache_directory=cache_directory))
+
+    if args.subject_lists:
+        cohorts = read_cohorts(args.subject_lists)
+        statistics = cohort_statistics(read_rows(cohorts["sid"]), cohorts)
+
+        figure_directory = Path(args.figure_directory)
+        figure_directory.mkdir(parents=True, exist_ok=True)
+        tasks = [(cohort_stats, units, f"COPD Gene Study Participant Statistics, Subjects: {cohort}\n",
+                  figure_directory / f"{cohort}.png") for cohort, cohort_stats in statistics.items()]
+        with pool.Pool(args.workers) as mpool:
+            for _ in tqdm(mpool.imap_unordered(save_figure, tasks), desc="Rendering figures", total=len(tasks)):
+                pass
+        return
+
+    # A single cohort is summarised through its aggregate cube, which is cached and updated incrementally when the
+    # subject list changes
+    sids = subject_list["sid"] if use_subject_list else None
+    cohort = Path(subject_list_file).stem if use_subject_list else ""
+    if cache_directory is not None:
+        cube = subject_cube.cached_cube(data_file, data_dict_file, cohort, sids, read_rows, cache_directory,
+                                        cube_dimensions, cube_bin_widths)
+    else:
+        cube = subject_cube.AggregateCube.from_rows(read_rows(sids), cube_dimensions, cube_bin_widths)
+
+    if args.query_by is not None:
+        print(cube.query(args.query_by, **parse_query(args.query or [])).to_string())
+        return
 
     fig_title = "COPD Gene Study Participant Statistics\n"
     if use_subject_list:
-        data = data.loc[data["sid"].isin(subject_list["sid"])]
         fig_title = f"COPD Gene Study Participant Statistics, Subjects: {str(Path(subject_list_file).stem)}\n"
 
-    data_dict = pd.read_excel(data_dict_file)
-    data_dict = data_dict.set_index("VariableName")
+    import matplotlib.pyplot as plt
+    plot_statistics(plt.figure(layout="constrained"), cube_statistics(cube), units, fig_title)
+    plt.show()
+
+
+def parse_query(filters):
+    """
+    Parse --query filters into keyword arguments of AggregateCube.query
+    """
+    query = {}
+    for query_filter in filters:
+        column, value = query_filter.split("=", 1)
+        if column in cube_bin_widths:
+            low, _, high = value.partition(":")
+            query[column] = (float(low) if low else None, float(high) if high else None)
+        elif "," in value:
+            query[column] = value.split(",")
+        else:
+            query[column] = value
+    return query
+
+
+def read_cohorts(subject_list_files):
+    """
+    Read subject lists as cohorts named after their files
+
+    Returns
+    -------
+    cohorts
+        DataFrame with sid and cohort columns. A subject can be in several cohorts
+    """
+    return pd.concat([pd.read_csv(file, usecols=["sid"]).assign(cohort=Path(file).stem)
+                      for file in subject_list_files], ignore_index=True)
 
-    # Race
-    race_counts = data["race"].value_counts()
-    race_vals = data_dict["CodedValues"]["race"]
-    race_mapping = parse_discrete(race_vals)
 
-    # Gold Stage
-    gold_counts = data["finalgold_baseline"].value_counts()
-    gold_vals = data_dict["CodedValues"]["finalgold_baseline"]
-    gold_mapping = parse_discrete(gold_vals)
+def cohort_statistics(data, cohorts):
+    """
+    Count the participants of every cohort by gold stage, race and gender, and bin their age, height and weight,
+    with one groupby over all cohorts per statistic
 
-    # Gender
-    gender_counts = data["gender"].value_counts()
-    gender_vals = data_dict["CodedValues"]["gender"]
-    gender_mapping = parse_discrete(gender_vals)
+    Parameters
+    ----------
+    data
+        Decoded subject data
+    cohorts
+        DataFrame with sid and cohort columns
 
-    fig, axs = plt.subplots(2, 3, layout="constrained")
-    axs[0, 0].bar([gold_mapping[i].split("(")[0] for i in gold_counts.index], gold_counts)
+    Returns
+    -------
+    statistics
+        Dict of cohort to a dict of column to counts. Counts of coded columns are Series of labels, most common first,
+        and histograms are (counts, bin edges) on the grid of multiples of bin_width that aggregate cubes use
+    """
+    rows = cohorts[["sid", "cohort"]].drop_duplicates().merge(data, on="sid")
+    statistics = {cohort: {column: pd.Series(dtype="int64") for column in count_columns}
+                  | {column: (np.zeros(0, dtype=np.int64), np.zeros(1)) for column in histogram_columns}
+                  for cohort in cohorts["cohort"].unique()}
+
+    for column in count_columns:
+        counts = rows.groupby(["cohort", column], observed=True).size()
+        for cohort, cohort_counts in counts.groupby(level="cohort"):
+            statistics[cohort][column] = cohort_counts.droplevel("cohort").sort_values(ascending=False, kind="stable")
+
+    for column in histogram_columns:
+        values = rows[column].astype("float64")
+        if values.isna().all():
+            continue
+        counts = rows[["cohort"]].assign(bin=np.floor(values / bin_width)).dropna().groupby(["cohort", "bin"]).size()
+        for cohort, cohort_counts in counts.groupby(level="cohort"):
+            cohort_counts = cohort_counts.droplevel("cohort")
+            bins = np.arange(cohort_counts.index.min(), cohort_counts.index.max() + 2)
+            statistics[cohort][column] = (cohort_counts.reindex(bins[:-1], fill_value=0).to_numpy(),
+                                          bin_width * bins)
+
+    return statistics
+
+
+def cube_statistics(cube):
+    """
+    Statistics of a cohort, in the format of cohort_statistics, summed from its aggregate cube
+    """
+    statistics = {}
+    for column in count_columns:
+        counts = cube.query(column)
+        statistics[column] = counts[counts.index.notna()]
+    for column in histogram_columns:
+        statistics[column] = cube.histogram(column)
+    return statistics
+
+
+def plot_statistics(fig, statistics, units, fig_title):
+    """
+    Draw the 2x3 participant statistics of one cohort on a figure
+
+    Parameters
+    ----------
+    fig
+        matplotlib Figure
+    statistics
+        Statistics of the cohort from cohort_statistics
+    units
+        Dict of histogram column to units
+    fig_title
+    """
+    axs = fig.subplots(2, 3)
+
+    gold_counts = statistics["finalgold_baseline"]
+    axs[0, 0].bar([str(label).split("(")[0] for label in gold_counts.index], gold_counts)
     axs[0, 0].set_ylabel("Number of Participants")
     axs[0, 0].set_title("Participants by COPD Gold Stage")
-    axs[0, 0].set_xticks(range(len(axs[0, 0].get_xticks())), axs[0, 0].get_xticklabels(), rotation=45)
+    axs[0, 0].tick_params(axis="x", labelrotation=45)
 
-    axs[0, 1].bar([race_mapping[i] for i in race_counts.index], race_counts)
+    race_counts = statistics["race"]
+    axs[0, 1].bar(race_counts.index.astype(str), race_counts)
     axs[0, 1].set_ylabel("Number of Participants")
     axs[0, 1].set_title("Participants by Race")
 
-    axs[0, 2].bar([gender_mapping[i] for i in gender_counts.index], gender_counts)
+    gender_counts = statistics["gender"]
+    axs[0, 2].bar(gender_counts.index.astype(str), gender_counts)
     axs[0, 2].set_ylabel("Number of Participants")
     axs[0, 2].set_title("Participants by Gender")
 
-    axs[1, 0].hist(data["age_baseline"], bins=int((max(data["age_baseline"]) - min(data["age_baseline"])) / 2.5))
-    axs[1, 0].set_ylabel("Number of Participants")
-    axs[1, 0].set_xlabel(f"Age ({data_dict['Units']['age_baseline']})")
-    axs[1, 0].set_title(f"Age at Baseline ({data_dict['Units']['age_baseline']})")
-
-    axs[1, 1].hist(data["Height_CM"], bins=int((max(data["Height_CM"]) - min(data["Height_CM"])) / 2.5))
-    axs[1, 1].set_ylabel("Number of Participants")
-    axs[1, 1].set_xlabel(f"Height ({data_dict['Units']['Height_CM']})")
-    axs[1, 1].set_title(f"Height ({data_dict['Units']['Height_CM']})")
-
-    axs[1, 2].hist(data["Weight_KG"], bins=int((max(data["Weight_KG"]) - min(data["Weight_KG"])) / 2.5))
-    axs[1, 2].set_ylabel("Number of Participants")
-    axs[1, 2].set_xlabel(f"Weight ({data_dict['Units']['Weight_KG']})")
-    axs[1, 2].set_title(f"Weight ({data_dict['Units']['Weight_KG']})")
+    for ax, column, name, title in [(axs[1, 0], "age_baseline", "Age", "Age at Baseline"),
+                                    (axs[1, 1], "Height_CM", "Height", "Height"),
+                                    (axs[1, 2], "Weight_KG", "Weight", "Weight")]:
+        counts, edges = statistics[column]
+        if len(counts) > 0:
+            ax.stairs(counts, edges, fill=True)
+        ax.set_ylabel("Number of Participants")
+        ax.set_xlabel(f"{name} ({units[column]})")
+        ax.set_title(f"{title} ({units[column]})")
 
     fig.set_size_inches(15, 6)
     fig.suptitle(fig_title)
 
-    plt.show()
-
 
-def parse_discrete(coded_values: str):
-    pairs = coded_values.split(" | ")
-    mapping = {int(s[0]): s[1] for s in [pair.split("=") for pair in pairs]}
-    return mapping
+def save_figure(task):
+    """
+    Render the figure of one cohort straight to a file with the Agg canvas, without pyplot or a display
+    """
+    statistics, units, fig_title, path = task
+    from matplotlib.figure import Figure
+    fig = Figure(layout="constrained")
+    plot_statistics(fig, statistics, units, fig_title)
+    fig.savefig(path)
+    return path
 
 
 if __name__ == "__main__":
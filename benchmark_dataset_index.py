@@ -0,0 +1,169 @@
+import argparse
+import fnmatch
+from pathlib import Path
+import time
+
+import numpy as np
+import pandas as pd
+
+from analyse_copdgene_dataset_index import (arrow_strings, explode_files, inex_pattern, phase_pattern,
+                                            subject_pattern)
+
+"""
+Benchmark of vectorised subject and lobe segmentation discovery, with the Arrow string parsing of
+analyse_copdgene_dataset_index, against the previous per row loop, on a synthetic per directory (TSV) index laid out
+like the COPDGene dataset
+"""
+
+
+def run_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", help="Number of directory rows in the synthetic index", type=int, default=1000000)
+    parser.add_argument("--files", help="Number of files in each series directory", type=int, default=4)
+    args = parser.parse_args()
+
+    data = make_index(args.rows, args.files)
+    print(f"Synthetic index: {len(data)} directories")
+
+    start = time.perf_counter()
+    loop_subjects, loop_counts = find_loop(data, "COPD1", "EXP")
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    files = explode_files(data)
+    subjects = find_subjects(files)
+    counts = find_lobe_segmentations(files, "COPD1", "EXP").value_counts()
+    vectorised_seconds = time.perf_counter() - start
+
+    print(f"per row loop: {loop_seconds:.2f} s")
+    print(f"vectorised: {vectorised_seconds:.2f} s ({loop_seconds / vectorised_seconds:.1f}x)")
+    print(f"Same subjects: {set(subjects) == set(loop_subjects)}, "
+          f"same segmentation counts: {counts.to_dict() == loop_counts}")
+
+
+def make_index(rows, files_per_directory):
+    """
+    Per directory index of subject zips, each holding INSP and EXP series in two phases
+    """
+    series = [(phase, inex) for phase in ["COPD1", "COPD2"] for inex in ["INSP", "EXP"]]
+    rows_per_subject = 4 + len(series)
+    n_subjects = max(rows // rows_per_subject, 1)
+    subjects = [f"{10000 + i // 26:05d}{chr(ord('A') + i % 26)}" for i in range(n_subjects)]
+
+    dirpaths = ["."]
+    file_lists = [str([f"{subject}.zip" for subject in subjects])]
+    for i, subject in enumerate(subjects):
+        dirpaths.extend([".", subject])
+        file_lists.extend(["[]", "[]"])
+        for phase in ["COPD1", "COPD2"]:
+            dirpaths.append(f"{subject}/{phase}")
+            file_lists.append("[]")
+        for j, (phase, inex) in enumerate(series):
+            name = f"{subject}_{inex}_STD_NJC_COPD"
+            dirpaths.append(f"{subject}/{phase}/{name}")
+            names = [f"{k:06d}.dcm" for k in range(files_per_directory - 1)]
+            # Leave out a segmentation now and then so the counts vary
+            if (i + j) % 7 != 0:
+                names.append(f"{name}_Lobes.mhd")
+            file_lists.append(str(names))
+
+    return pd.DataFrame({"dirpath": dirpaths[:rows], "files": file_lists[:rows]})
+
+
+def find_subjects(files):
+    """
+    Subjects with a zip file in the index
+
+    Parameters
+    ----------
+    files
+        DataFrame with a name column, from explode_files
+
+    Returns
+    -------
+    subjects
+        Index of unique subject IDs
+    """
+    names = arrow_strings(files["name"])
+    subjects = names[names.str.endswith(".zip")].str.extract(subject_pattern, expand=False)
+    return pd.Index(subjects.dropna().unique())
+
+
+def find_lobe_segmentations(files, search_phase, search_inex):
+    """
+    Subject of every lobe segmentation in the index, optionally only those in one phase and INSP or EXP. The phase
+    is parsed once per distinct directory rather than once per file
+
+    Parameters
+    ----------
+    files
+        DataFrame with dirpath and name columns, from explode_files
+    search_phase
+        e.g. COPD1, or None for any phase
+    search_inex
+        INSP or EXP, or None for both
+
+    Returns
+    -------
+    subjects
+        Series with one subject ID per matching segmentation
+    """
+    names = arrow_strings(files["name"])
+    lobes = names.str.endswith("Lobes.mhd")
+    names = names[lobes]
+    subjects = names.str.extract(subject_pattern, expand=False)
+    match = subjects.notna()
+    if search_inex is not None:
+        match &= (names.str.extract(inex_pattern, expand=False) == search_inex).fillna(False)
+    if search_phase is not None:
+        codes, dirpaths = pd.factorize(arrow_strings(files["dirpath"][lobes]))
+        phases = pd.Series(dirpaths).str.extract(phase_pattern, expand=False)
+        match &= (phases == search_phase).fillna(False).to_numpy()[codes]
+    return subjects[match]
+
+
+def find_loop(data, search_phase, search_inex):
+    """
+    Subjects and per subject segmentation counts as the previous run_cli found them, row by row
+    """
+    subjects = set(flatten([find_subjects_loop(files) for files in data["files"]]))
+    segmentations = flatten([find_lobe_segmentations_loop(files, dirpath, search_phase, search_inex)
+                             for files, dirpath in zip(data["files"], data["dirpath"])])
+    unique, counts = np.unique(segmentations, return_counts=True)
+    return subjects, dict(zip(unique, counts))
+
+
+def flatten(l):
+    return [item for sublist in l for item in sublist]
+
+
+# Previous implementation, kept for comparison
+def find_subjects_loop(files):
+    subjects = []
+    files = files.split("'")
+    if len(zip_files := fnmatch.filter(files, "*.zip")) > 0:
+        for file in zip_files:
+            subject = file.strip(".zip")
+            subjects.append(subject)
+
+    return subjects
+
+
+def find_lobe_segmentations_loop(files, dirpath, search_phase, search_inex):
+    subjects = []
+    files = files.split("'")
+    if len(lobe_files := fnmatch.filter(files, "*Lobes.mhd")) > 0:
+        for file in lobe_files:
+            subject = file.split("_")[0]
+            phase = Path(dirpath).parents[0].name
+            inex = file.split("_")[1]
+            if search_phase is not None and phase != search_phase:
+                continue
+            if search_inex is not None and inex != search_inex:
+                continue
+            subjects.append(subject)
+    return subjects
+
+
+if __name__ == "__main__":
+    run_cli()
@@ -0,0 +1,52 @@
+import argparse
+import json
+from pathlib import Path
+import subprocess
+import sys
+
+"""
+Benchmark of the import time of each entry point, run in a fresh interpreter each time as a batch job would. Also
+reports which heavy optional modules the import pulled in
+"""
+
+entry_points = ["extract_zip_directory", "index_zip_folder", "analyse_copdgene_dataset_index",
+                "analyse_copdgene_subject_data", "joyce_code.main_improved"]
+heavy_modules = ["tkinter", "matplotlib", "pandas"]
+
+measure_import = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy_modules} if m in sys.modules]}}))
+"""
+
+
+def run_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", help="Number of fresh interpreters per entry point", type=int, default=5)
+    args = parser.parse_args()
+
+    for module in entry_points:
+        seconds, loaded = benchmark(module, args.repeats)
+        print(f"{module}: {seconds * 1000:.0f} ms, heavy modules loaded: {', '.join(loaded) or 'none'}")
+
+
+def benchmark(module, repeats):
+    """
+    Best import time of module over repeats fresh interpreters, and the heavy modules it loaded
+    """
+    times = []
+    loaded = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-c", measure_import.format(module=module, heavy_modules=heavy_modules)],
+                                cwd=Path(__file__).parent, capture_output=True, text=True, check=True)
+        measurement = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(measurement["seconds"])
+        loaded = measurement["loaded"]
+
+    return min(times), loaded
+
+
+if __name__ == "__main__":
+    run_cli()
@@ -0,0 +1,97 @@
+import argparse
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from index_zip_folder import zipwalk
+
+"""
+Micro-benchmark of index_zip_folder.zipwalk against the previous pathlib based implementation, on a synthetic zip
+laid out like a COPDGene subject zip (a few series directories holding thousands of DICOM slices each)
+"""
+
+
+def run_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", help="Number of file entries in the synthetic zip", type=int, default=100000)
+    parser.add_argument("--directories", help="Number of directories to spread the entries over", type=int,
+                        default=20)
+    parser.add_argument("--repeats", help="Number of timed repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zip_path = Path(tmp_dir) / "benchmark.zip"
+        make_zip(zip_path, args.entries, args.directories)
+
+        for name, walk in [("pathlib zipwalk", zipwalk_pathlib), ("streaming zipwalk", zipwalk)]:
+            seconds, peak = benchmark(walk, zip_path, args.repeats)
+            print(f"{name}: {seconds * 1000:.1f} ms per zip, peak walker memory {peak / 1e6:.1f} MB "
+                  f"({args.entries} entries)")
+
+
+def make_zip(zip_path, entries, directories):
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zfile:
+        per_directory = max(entries // directories, 1)
+        for i in range(entries):
+            series = f"10001A/COPD1/10001A_INSP_STD_{i // per_directory:03d}_COPD"
+            if i % per_directory == 0:
+                zfile.writestr(f"{series}/", b"")
+            zfile.writestr(f"{series}/{i:06d}.dcm", b"")
+
+
+def benchmark(walk, zip_path, repeats):
+    """
+    Time a full walk of a zip, including opening it, and measure the peak memory allocated during the walk. Both
+    walkers hold zipfile's central directory, so the difference in peak memory is the walker's own state
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in walk(zip_path):
+            pass
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    for _ in walk(zip_path):
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+# Previous implementation, kept for comparison
+def zipwalk_pathlib(file: Path):
+
+    zfile = zipfile.ZipFile(str(file))
+    # Initialize database
+    dlistdb = {}
+    # Walk through zip file information list
+    for info in zfile.infolist():
+        if info.is_dir():
+            zpath = Path(info.filename).parent
+            zfile = Path(info.filename).name
+            if zpath in dlistdb:
+                dlistdb[zpath][0].append(zfile)
+            else:
+                dlistdb[zpath] = [[zfile], []]
+        else:
+            zpath = Path(info.filename).parent
+            zfile = Path(info.filename).name
+            if zpath in dlistdb:
+                dlistdb[zpath][1].append(zfile)
+            else:
+                dlistdb[zpath] = [[], [zfile]]
+
+    # Convert to os.walk() output format
+    dlist = []
+    for key in dlistdb.keys():
+        dlist.append((key, dlistdb[key][0], dlistdb[key][1]))
+
+    return iter(dlist)
+
+
+if __name__ == "__main__":
+    run_cli()
@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+
+"""
+File dialogs for the command line interfaces. tkinter is only imported when a dialog is actually shown, so the
+scripts start quickly and run on headless nodes without a display
+"""
+
+tk_root = None
+
+
+def add_interactive_argument(parser: argparse.ArgumentParser):
+    parser.add_argument("--interactive", help="Ask for missing arguments with file dialogs. Defaults to on when a "
+                                              "display is available", default=None,
+                        action=argparse.BooleanOptionalAction)
+
+
+def is_interactive(args):
+    """
+    Whether file dialogs should be shown, from the --interactive argument or, if it was not given, whether there is
+    a display to show them on
+    """
+    if args.interactive is not None:
+        return args.interactive
+    if sys.platform in ["win32", "darwin"]:
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def get_tk_root():
+    global tk_root
+    if tk_root is None:
+        import tkinter as tk
+        tk_root = tk.Tk()
+        tk_root.withdraw()
+    return tk_root
+
+
+def ask_directory(title):
+    from tkinter.filedialog import askdirectory
+    get_tk_root()
+    return askdirectory(title=title)
+
+
+def ask_open_filename(title):
+    from tkinter.filedialog import askopenfilename
+    get_tk_root()
+    return askopenfilename(title=title)
@@ -0,0 +1,617 @@
+import functools
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+"""
+Loading of the COPDGene subject data files (e.g. COPDGene_Phase1_SM_NS_25OCT21.txt), which are tab separated with one
+row per subject and thousands of columns. Only the requested columns are parsed, rows can be filtered by subject while
+streaming through the file in chunks, and columns are stored with compact dtypes. Parsed files, and the Excel data
+dictionary, can be cached as memory mapped Feather files that are rebuilt whenever the source changes
+"""
+
+sid_column = "sid"
+default_chunksize = 50000
+default_cache_directory = Path("output") / "cache"
+
+
+def read_subject_data(data_file, columns=None, sids=None, dtypes=None, chunksize=default_chunksize,
+                      cache_directory=None, progress=None):
+    """
+    Load a subject data file with compact dtypes
+
+    Parameters
+    ----------
+    data_file
+        Tab separated subject data file
+    columns
+        Columns to load, or None for all. sid is always loaded
+    sids
+        Subjects to keep, or None for all. The file is streamed in chunks and only matching rows are kept, so the
+        whole file is never held in memory
+    dtypes
+        Dict of column to dtype to parse with, e.g. a CategoricalDtype for a coded column. Other columns are
+        compacted with compact_dtypes
+    chunksize
+        Rows per chunk
+    cache_directory
+        Directory to cache the parsed file in, or None to parse it every time. The first load parses every column of
+        the file and later loads memory map only the requested columns from the cache
+    progress
+        Function called with (bytes parsed, file size) while the file is parsed, or None. An exception it raises
+        stops the load, e.g. to cancel it. Loads from the cache do not parse the file and report nothing
+
+    Returns
+    -------
+    data
+        DataFrame with sid followed by the requested columns
+    """
+    if cache_directory is not None:
+        read = functools.partial(read_subject_table, chunksize=chunksize, progress=progress)
+        data = read_cached(data_file, read, cache_directory, columns=usecols(columns))
+        if sids is not None:
+            data = data[data[sid_column].isin(pd.Index(sids).unique())].reset_index(drop=True)
+        if dtypes:
+            data = data.astype(dtypes)
+        return data[usecols(columns)] if columns is not None else data
+
+    chunks = list(iter_subject_data(data_file, columns=columns, sids=sids, dtypes=dtypes, chunksize=chunksize,
+                                    progress=progress))
+    if chunks:
+        data = pd.concat(chunks, ignore_index=True)
+    else:
+        data = pd.read_csv(data_file, sep="\t", usecols=usecols(columns), dtype=dtypes, nrows=0)
+    data = compact_dtypes(data, exclude=list(dtypes or []))
+    return data[usecols(columns)] if columns is not None else data
+
+
+def iter_subject_data(data_file, columns=None, sids=None, dtypes=None, chunksize=default_chunksize, progress=None):
+    """
+    Stream a subject data file in chunks of rows, with the same arguments as read_subject_data. Chunks keep the dtypes
+    read_csv parses them with
+
+    Yields
+    ------
+    chunk
+        DataFrame of the rows of one chunk that match sids
+    """
+    sids = pd.Index(sids).unique() if sids is not None else None
+    with open_source(data_file, progress) as f:
+        for chunk in pd.read_csv(f, sep="\t", usecols=usecols(columns), dtype=dtypes, chunksize=chunksize):
+            if sids is not None:
+                chunk = chunk[chunk[sid_column].isin(sids)]
+            if len(chunk) > 0:
+                yield chunk
+
+
+def write_subject_data(data: pd.DataFrame, path, columns=None, chunksize=default_chunksize, progress=None):
+    """
+    Write subject data to a file in chunks of rows, so only one chunk of the chosen columns is ever copied. The
+    format follows the file name: .parquet for Parquet, .csv.gz or .gz for gzip compressed CSV, and CSV otherwise.
+    The file is written under a temporary name and only replaces path once complete
+
+    Parameters
+    ----------
+    data
+    path
+    columns
+        Columns to write, in order, or None for all
+    chunksize
+        Rows per chunk
+    progress
+        Function called with (rows written, total rows) after every chunk, or None. An exception it raises stops the
+        write, e.g. to cancel it, and removes the partial file
+    """
+    path = Path(path)
+    columns = list(columns) if columns is not None else list(data.columns)
+    if missing := [column for column in columns if column not in data.columns]:
+        raise ValueError(f"Unknown columns: {', '.join(missing)}")
+    positions = data.columns.get_indexer(columns)
+
+    def chunks():
+        # An empty frame still gives one (empty) chunk, for the header or schema
+        for start in range(0, max(len(data), 1), chunksize):
+            yield data.iloc[start:start + chunksize, positions]
+            if progress is not None:
+                progress(min(start + chunksize, len(data)), len(data))
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        if path.suffix.lower() == ".parquet":
+            write_parquet_chunks(chunks(), tmp_path)
+        else:
+            opener = functools.partial(gzip.open, compresslevel=6) if path.suffix.lower() == ".gz" else open
+            with opener(tmp_path, "wt", newline="") as f:
+                for i, chunk in enumerate(chunks()):
+                    chunk.to_csv(f, index=False, header=i == 0)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def write_parquet_chunks(chunks, path):
+    """
+    Write frames with the same columns to one Parquet file, a row group each, using the schema of the first
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, schema=writer.schema if writer is not None else None,
+                                         preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def usecols(columns):
+    if columns is None:
+        return None
+    return list(dict.fromkeys([sid_column, *columns]))
+
+
+def compact_dtypes(data: pd.DataFrame, exclude=()):
+    """
+    Store every column of a frame in a compact dtype with compact_column, except sid, which is unique per subject
+
+    Parameters
+    ----------
+    data
+    exclude
+        Columns to leave as they are, e.g. those parsed with explicit dtypes
+    """
+    columns = {column: compact_column(data[column]) for column in data.columns
+               if column != sid_column and column not in exclude}
+    return data.assign(**columns) if columns else data
+
+
+def compact_column(values: pd.Series):
+    """
+    Downcast whole numbers to the smallest integer type that holds them, floats (including whole numbers with
+    missing values, which keep NaN rather than becoming nullable integers) to float32 when every value survives the
+    round trip exactly, and text to a categorical. Other floats keep float64, so no value is rounded
+    """
+    if pd.api.types.is_bool_dtype(values) or isinstance(values.dtype, pd.CategoricalDtype):
+        return values
+    if pd.api.types.is_integer_dtype(values):
+        return pd.to_numeric(values, downcast="integer")
+    if pd.api.types.is_float_dtype(values):
+        if len(values) > 0 and np.isfinite(values).all() and (values == np.round(values)).all():
+            return pd.to_numeric(values.astype("int64"), downcast="integer")
+        compact = values.astype("float32")
+        if ((compact.astype("float64") == values) | values.isna()).all():
+            return compact
+        return values.astype("float64")
+    if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+        return values.astype("category")
+    return values
+
+
+def read_subject_table(data_file, chunksize=default_chunksize, progress=None):
+    """
+    Parse every column of a subject data file with compact dtypes, for the cache, in chunks of rows. A first pass
+    over the file summarises every column to choose the dtype compact_column would choose for the whole column, so
+    every chunk of the second pass has the same dtypes and only one chunk is held in memory at a time
+
+    Parameters
+    ----------
+    data_file
+    chunksize
+        Rows per chunk
+    progress
+        As read_subject_data, counting the bytes of both passes
+
+    Yields
+    ------
+    chunk
+        DataFrame of the next rows of the file
+    """
+    def pass_progress(offset):
+        if progress is None:
+            return None
+        return lambda done, total: progress(offset * total + done, 2 * total)
+
+    summaries = {}
+    with open_source(data_file, pass_progress(0)) as f:
+        for chunk in pd.read_csv(f, sep="\t", chunksize=chunksize):
+            for column in chunk.columns:
+                summaries.setdefault(column, ColumnSummary()).update(chunk[column])
+    if not summaries:
+        yield compact_dtypes(pd.read_csv(data_file, sep="\t", nrows=0))
+        return
+
+    # Columns that are text in some chunks and numbers in others are read as text throughout, so their categories
+    # are only known once they have all been read as text
+    if mixed := [column for column, summary in summaries.items() if summary.mixed and column != sid_column]:
+        for chunk in pd.read_csv(data_file, sep="\t", usecols=mixed, dtype=str, chunksize=chunksize):
+            for column in mixed:
+                summaries[column].categories.update(chunk[column].dropna().unique())
+
+    parse_dtypes = {column: summary.parse_dtype() for column, summary in summaries.items()}
+    dtypes = {column: summary.compact_dtype() if column != sid_column else parse_dtypes[column]
+              for column, summary in summaries.items()}
+    with open_source(data_file, pass_progress(1)) as f:
+        for chunk in pd.read_csv(f, sep="\t", dtype=parse_dtypes, chunksize=chunksize):
+            yield chunk.astype(dtypes)
+
+
+class ColumnSummary:
+    """
+    Running summary of one column over chunks of rows, as read_csv parses them, enough to choose the dtype
+    compact_column would choose for the whole column
+    """
+
+    def __init__(self):
+        self.kind = None  # "bool", "int", "float" or "text", or None until a chunk has values
+        self.mixed = False
+        self.has_na = False
+        self.min = None
+        self.max = None
+        self.whole = True
+        self.exact32 = True
+        self.categories = set()
+
+    def update(self, values: pd.Series):
+        missing = values.isna()
+        if missing.all():
+            # read_csv parses a chunk without values as float, whatever the rest of the column holds
+            self.has_na = True
+            self.whole = False
+            return
+        self.has_na |= bool(missing.any())
+        present = values[~missing]
+        if pd.api.types.is_bool_dtype(values) or (pd.api.types.is_object_dtype(values)
+                                                  and present.map(type).eq(bool).all()):
+            # read_csv parses True/False with missing values as objects
+            kind = "bool"
+        else:
+            kind = ("int" if pd.api.types.is_integer_dtype(values) else "float" if pd.api.types.is_float_dtype(values)
+                    else "text")
+        if self.kind is not None and kind != self.kind:
+            if {kind, self.kind} == {"int", "float"}:
+                kind = "float"
+            else:
+                kind = "text"
+                if not self.mixed:
+                    self.mixed = True
+                    self.categories = set()
+        self.kind = kind
+
+        if kind in ["text", "bool"]:
+            if not self.mixed:
+                self.categories.update(present.unique())
+        else:
+            numbers = values.to_numpy(dtype="float64", na_value=np.nan)
+            self.min = min(self.min, np.nanmin(numbers)) if self.min is not None else np.nanmin(numbers)
+            self.max = max(self.max, np.nanmax(numbers)) if self.max is not None else np.nanmax(numbers)
+            self.whole &= bool(np.isfinite(numbers).all() and (numbers == np.round(numbers)).all())
+            self.exact32 &= bool(((numbers.astype("float32").astype("float64") == numbers) | np.isnan(numbers)).all())
+
+    def parse_dtype(self):
+        """
+        dtype for read_csv to parse the column with in every chunk. Integer and True/False columns with missing
+        values, in any chunk, are parsed as float and nullable boolean
+        """
+        if self.kind == "bool":
+            return "boolean" if self.has_na else "bool"
+        return {"int": "float64" if self.has_na else "int64", "text": "str"}.get(self.kind, "float64")
+
+    def compact_dtype(self):
+        """
+        dtype compact_column would give the whole column
+        """
+        if self.kind == "bool":
+            # read_csv gives a whole True/False column with missing values as objects, which become categories
+            return pd.CategoricalDtype(pd.Index(sorted(self.categories), dtype=bool)) if self.has_na else "bool"
+        if self.kind == "text":
+            return pd.CategoricalDtype(pd.Index(sorted(self.categories), dtype="str"))
+        if (self.kind == "int" or (self.kind == "float" and self.whole)) and not self.has_na:
+            return next(dtype for dtype in [np.int8, np.int16, np.int32, np.int64]
+                        if np.iinfo(dtype).min <= self.min and self.max <= np.iinfo(dtype).max)
+        return "float32" if self.exact32 else "float64"
+
+
+def open_source(source, progress=None):
+    """
+    Open a file for parsing, wrapped in a ProgressReader when progress is given
+    """
+    f = open(source, "rb")
+    return ProgressReader(f, progress) if progress is not None else f
+
+
+class ProgressReader:
+    """
+    Binary file wrapper calling progress(bytes read, file size) on every read, so a parser reading through it reports
+    its progress and is stopped by any exception progress raises
+    """
+
+    def __init__(self, file, progress):
+        self.file = file
+        self.progress = progress
+        self.total = os.fstat(file.fileno()).st_size
+        self.position = 0
+
+    def read(self, size=-1):
+        return self.report(self.file.read(size))
+
+    def read1(self, size=-1):
+        return self.report(self.file.read1(size))
+
+    def report(self, data):
+        self.position += len(data)
+        self.progress(self.position, self.total)
+        return data
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def read_data_dictionary(data_dict_file, cache_directory=None):
+    """
+    Load the COPDGene data dictionary Excel file, indexed by VariableName
+
+    Parameters
+    ----------
+    data_dict_file
+    cache_directory
+        Directory to cache the parsed dictionary in, or None to parse it every time
+    """
+    if cache_directory is not None:
+        data_dict = read_cached(data_dict_file, read_data_dictionary_table, cache_directory)
+    else:
+        data_dict = read_data_dictionary_table(data_dict_file)
+    return data_dict.set_index("VariableName")
+
+
+class SubjectTable:
+    """
+    Columns of a subject data file indexed by sid, loaded once to serve any number of subject lists
+    """
+
+    def __init__(self, data_file, columns=None, sids=None, cache_directory=None):
+        """
+        Parameters
+        ----------
+        data_file
+        columns
+            Every column any list will retrieve, or None for all
+        sids
+            Every subject any list will retrieve, or None for all
+        cache_directory
+            As read_subject_data
+        """
+        data = read_subject_data(data_file, columns=columns, sids=sids, cache_directory=cache_directory)
+        self.data = data.drop_duplicates(sid_column).set_index(sid_column)
+
+    def retrieve(self, subject_list: pd.DataFrame, columns=None):
+        """
+        Join columns onto a subject list by sid with a hash lookup, as a left merge would. Subjects missing from the
+        data get NaN, and the list's order and columns are kept
+
+        Parameters
+        ----------
+        subject_list
+            DataFrame with a sid column
+        columns
+            Columns to retrieve, or None for all loaded columns. sid is ignored
+
+        Returns
+        -------
+        merged
+        """
+        columns = [column for column in (columns if columns is not None else self.data.columns) if column != sid_column]
+        return subject_list.join(self.data[columns], on=sid_column, lsuffix="_x", rsuffix="_y")
+
+
+class DataDictionary:
+    """
+    Decoder for the coded variables of the data dictionary. The CodedValues of every variable (e.g.
+    "1=Male | 2=Female") are parsed once into a lookup array from code to category and a CategoricalDtype of the
+    labels, so a whole column is decoded in one vectorised step. Holds only arrays, dicts and dtypes, so it pickles
+    to worker processes.
+    """
+
+    def __init__(self, data_dict: pd.DataFrame):
+        """
+        Parameters
+        ----------
+        data_dict
+            Data dictionary from read_data_dictionary, indexed by VariableName
+        """
+        self.units = data_dict["Units"].dropna().to_dict() if "Units" in data_dict.columns else {}
+        self.offsets = {}
+        self.lookups = {}
+        self.dtypes = {}
+        for variable, coded_values in data_dict["CodedValues"].dropna().items():
+            if (mapping := parse_coded_values(coded_values)) is None:
+                continue
+            codes = np.fromiter(mapping.keys(), dtype=np.int64, count=len(mapping))
+            labels = pd.Index(mapping.values())
+            categories = labels.unique()
+            lookup = np.full(codes.max() - codes.min() + 1, -1, dtype=np.int32)
+            lookup[codes - codes.min()] = categories.get_indexer(labels)
+            self.offsets[variable] = codes.min()
+            self.lookups[variable] = lookup
+            self.dtypes[variable] = pd.CategoricalDtype(categories)
+
+    def __contains__(self, variable):
+        return variable in self.lookups
+
+    def mapping(self, variable):
+        """
+        Dict of code to label of a coded variable
+        """
+        categories = self.dtypes[variable].categories
+        return {int(i + self.offsets[variable]): categories[c] for i, c in enumerate(self.lookups[variable]) if c >= 0}
+
+    def decode(self, values: pd.Series, variable=None):
+        """
+        Decode a column of codes into a categorical of labels. Missing values and codes not in the dictionary
+        become NaN
+
+        Parameters
+        ----------
+        values
+            Codes
+        variable
+            Variable name, defaults to the name of values
+        """
+        variable = variable if variable is not None else values.name
+        lookup = self.lookups[variable]
+        codes = pd.to_numeric(values, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        positions = codes - self.offsets[variable]
+        valid = (positions >= 0) & (positions < len(lookup)) & (positions == np.round(positions))
+        category_codes = np.full(len(codes), -1, dtype=np.int32)
+        category_codes[valid] = lookup[positions[valid].astype(np.int64)]
+        return pd.Series(pd.Categorical.from_codes(category_codes, dtype=self.dtypes[variable]), index=values.index,
+                         name=values.name)
+
+    def decode_frame(self, data: pd.DataFrame):
+        """
+        Decode every coded column of a frame
+        """
+        return data.assign(**{column: self.decode(data[column]) for column in data.columns if column in self})
+
+
+def parse_coded_values(coded_values: str):
+    """
+    Parse a CodedValues string such as "0=Never | 1=Former | 10=Unknown" into a dict of integer code to label, or
+    return None if the codes are not integers
+    """
+    mapping = {}
+    for pair in coded_values.split("|"):
+        code, separator, label = pair.partition("=")
+        if not separator:
+            continue
+        try:
+            mapping[int(code.strip())] = label.strip()
+        except ValueError:
+            return None
+    return mapping or None
+
+
+def read_data_dictionary_table(data_dict_file):
+    data_dict = pd.read_excel(data_dict_file)
+    # Excel columns can mix numbers and text, which Arrow cannot store in one column
+    text = [column for column in data_dict.columns if pd.api.types.is_object_dtype(data_dict[column])]
+    return data_dict.astype({column: "string" for column in text})
+
+
+def read_cached(source, read, cache_directory, columns=None):
+    """
+    Load a table through a Feather cache. The cache is keyed on the absolute path, size and mtime of the source, and
+    rebuilt with read when any of them changes or it cannot be read. Loads from the cache are memory mapped and only
+    read the requested columns
+
+    Parameters
+    ----------
+    source
+        Source file
+    read
+        Function parsing the source into a DataFrame, or into an iterable of DataFrames with the same dtypes that are
+        written to the cache one at a time
+    cache_directory
+    columns
+        Columns to load, or None for all. Raises KeyError for columns the source does not have
+
+    Returns
+    -------
+    data
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    source = Path(source).absolute()
+    key = source_key(source)
+    cache_path = cache_file(source, cache_directory, ".feather")
+
+    # Only the schema is read to check the cache, so a stale or unreadable cache is rebuilt but a request for columns
+    # the source does not have is not
+    schema = None
+    if cache_path.exists():
+        try:
+            with pa.memory_map(str(cache_path)) as f:
+                schema = pa.ipc.open_file(f).schema
+        except (pa.ArrowInvalid, OSError):
+            schema = None
+        if schema is not None and json.loads((schema.metadata or {}).get(b"cache_key", b"null")) != key:
+            schema = None
+
+    if schema is None:
+        data = read(source)
+        schema = write_cache(cache_path, [data] if isinstance(data, pd.DataFrame) else data, key)
+
+    if columns is not None and (missing := [column for column in columns if column not in schema.names]):
+        raise KeyError(f"Columns not in {source.name}: {', '.join(missing)}")
+    return feather.read_table(cache_path, columns=columns, memory_map=True).to_pandas()
+
+
+def write_cache(cache_path, chunks, key):
+    """
+    Write frames with the same columns and dtypes to an uncompressed Feather file, one chunk at a time, recording key
+    in the schema metadata. The file is written under a temporary name and only replaces cache_path once complete
+
+    Returns
+    -------
+    schema
+        Schema of the written file
+    """
+    import pyarrow as pa
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    schema = None
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            if writer is None:
+                schema = table.schema.with_metadata({**(table.schema.metadata or {}), b"cache_key": json.dumps(key)})
+                table = table.replace_schema_metadata(schema.metadata)
+                writer = pa.ipc.new_file(str(tmp_path), schema)
+            writer.write_table(table)
+        writer.close()
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return schema
+
+
+def source_key(source):
+    """
+    Absolute path, size and mtime of a source file, which change whenever the file is replaced or modified
+    """
+    source = Path(source).absolute()
+    stat = source.stat()
+    return {"source": str(source), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def cache_file(source, cache_directory, suffix):
+    """
+    Path in the cache directory for something derived from a source file, unique to the source's absolute path
+    """
+    source = Path(source).absolute()
+    return Path(cache_directory) / f"{source.stem}-{hashlib.sha1(str(source).encode()).hexdigest()[:12]}{suffix}"
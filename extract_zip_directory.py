@@ -1,6 +1,5 @@
 import argparse
-import tkinter as tk
-from tkinter.filedialog import askdirectory, askopenfilename
+import cli_prompts
 import os
 from pathlib import Path, PurePosixPath
 from tqdm import tqdm
@@ -9,11 +8,25 @@ from multiprocessing import pool
 import fnmatch
 import functools
 import numpy as np
+import posixpath
+import re
+import json
+import shutil
+import threading
+import time
+import extraction_pipeline
+import extraction_telemetry
+import multiprocessing
+import queue
+import contextlib
 
 """
 Script to extract all zip files in a directory
 """
 
+default_split_size = 2**30
+manifest_directory_name = "extraction_manifest"
+
 
 def run_cli():
     """
@@ -24,48 +37,115 @@ def run_cli():
     parser.add_argument("--output_root", help="Directory in which to place extracted files", type=str)
     parser.add_argument("--select_files", help="csv containing list of files to select", type=str)
     parser.add_argument("--skip_files", help="csv containing list of files to skip", type=str)
+    parser.add_argument("--include", help="Only extract zip members matching these globs, e.g. *Lobes.mhd",
+                        nargs="+", type=str)
+    parser.add_argument("--exclude", help="Do not extract zip members matching these globs", nargs="+", type=str)
+    parser.add_argument("--index", help="Parquet or SQLite dataset index (from index_zip_folder --format parquet or "
+                                        "sqlite) of zip_root, used with --index_query to choose members. Only the "
+                                        "zip files it lists are opened, and zip_root is not walked", type=str)
+    parser.add_argument("--index_query", help="Criteria for members to extract from the dataset index, "
+                                              "e.g. suffix=Lobes.mhd phase=COPD1 inex=EXP", nargs="+", type=str)
+    parser.add_argument("--split_size", help="Zip files with more than this many MB to extract are split into "
+                                             "member ranges extracted by different workers", type=int,
+                        default=default_split_size // 2**20)
+    parser.add_argument("--resume", help="Skip members recorded in the extraction manifest of output_root whose "
+                                         "extracted size still matches", default=False,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument("--workers", help="Number of worker processes. Defaults to the number of cpus", type=int)
+    parser.add_argument("--pipeline", help="Extract with overlapped read, inflate and write threads in each worker. "
+                                           "Implied by any of the pipeline options below", default=None,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument("--io_threads", help="Pipeline reader and writer threads per worker, unless set separately "
+                                             "(default 2)", type=int)
+    parser.add_argument("--read_threads", help="Pipeline reader threads per worker", type=int)
+    parser.add_argument("--inflate_threads", help="Pipeline decompression threads per worker (default 2)", type=int)
+    parser.add_argument("--write_threads", help="Pipeline writer threads per worker", type=int)
+    parser.add_argument("--buffer_size", help="Pipeline read and inflate buffer size (KB) (default "
+                                              f"{extraction_pipeline.default_buffer_size // 2**10})", type=int)
+    parser.add_argument("--queue_depth", help="Number of buffers or members that can wait between pipeline stages "
+                                              "(default 8)", type=int)
+    parser.add_argument("--memory_budget", help="Memory (MB) for pipeline buffers across all workers. Sets the "
+                                                "buffer size so the queues cannot hold more than this", type=int)
+    parser.add_argument("--telemetry", help="JSON lines file to append live throughput snapshots to", type=str)
+    parser.add_argument("--telemetry_interval", help="Seconds between telemetry snapshots", type=float, default=5.0)
+    cli_prompts.add_interactive_argument(parser)
     args = parser.parse_args()
+    interactive = cli_prompts.is_interactive(args)
+
+    pipeline_arguments = ["io_threads", "read_threads", "inflate_threads", "write_threads", "buffer_size",
+                          "queue_depth", "memory_budget"]
+    if given := [f"--{name}" for name in pipeline_arguments if getattr(args, name) is not None]:
+        if args.pipeline is False:
+            parser.error(f"{', '.join(given)} only apply with --pipeline")
+        args.pipeline = True
 
     if args.zip_root is not None:
         zip_root = Path(args.zip_root)
     else:
-        tk.Tk().withdraw()
-        if not (zip_root := askdirectory(title="Select zip_root directory")):
+        if not interactive:
+            parser.error("--zip_root is required when not interactive")
+        if not (zip_root := cli_prompts.ask_directory("Select zip_root directory")):
             exit()
         zip_root = Path(zip_root)
 
     if args.output_root is not None:
         output_root = Path(args.output_root)
     else:
-        tk.Tk().withdraw()
-        if not (output_root := askdirectory(title="Select output_root directory")):
+        if not interactive:
+            parser.error("--output_root is required when not interactive")
+        if not (output_root := cli_prompts.ask_directory("Select output_root directory")):
             exit()
         output_root = Path(output_root)
 
+    # The select and skip lists are optional, so they are only asked for interactively
     if args.select_files is not None:
         select_files = np.loadtxt(Path(args.select_files),dtype=str, delimiter=",")
+    elif interactive and (select_files := cli_prompts.ask_open_filename(
+            "Select select files list (or cancel to continue)")):
+        select_files = np.loadtxt(Path(select_files),dtype=str, delimiter=",")
     else:
-        tk.Tk().withdraw()
-        if not (select_files := askopenfilename(title="Select select files list (or cancel to continue)")):
-            select_files = None
-        else:
-            select_files = np.loadtxt(Path(select_files),dtype=str, delimiter=",")
+        select_files = None
 
     if args.skip_files is not None:
         skip_files = np.loadtxt(Path(args.skip_files),dtype=str, delimiter=",")
+    elif interactive and (skip_files := cli_prompts.ask_open_filename(
+            "Select skip files list (or cancel to continue)")):
+        skip_files = np.loadtxt(Path(skip_files),dtype=str, delimiter=",")
     else:
-        tk.Tk().withdraw()
-        if not (skip_files := askopenfilename(title="Select skip files list (or cancel to continue)")):
-            skip_files = None
-        else:
-            skip_files = np.loadtxt(Path(skip_files),dtype=str, delimiter=",")
+        skip_files = None
+
+    index_members = None
+    if args.index is not None:
+        index_members = query_index_members(args.index, dict(c.split("=", 1) for c in args.index_query or []))
+
+    workers = args.workers if args.workers is not None else os.cpu_count()
+    pipeline_options = None
+    if args.pipeline:
+        io_threads = args.io_threads if args.io_threads is not None else 2
+        pipeline_options = {
+            "read_threads": args.read_threads if args.read_threads is not None else io_threads,
+            "inflate_threads": args.inflate_threads if args.inflate_threads is not None else 2,
+            "write_threads": args.write_threads if args.write_threads is not None else io_threads,
+            "buffer_size": (args.buffer_size if args.buffer_size is not None
+                            else extraction_pipeline.default_buffer_size // 2**10) * 2**10,
+            "queue_depth": args.queue_depth if args.queue_depth is not None else 8}
+        if args.memory_budget is not None:
+            pipeline_options = extraction_pipeline.fit_memory_budget(pipeline_options,
+                                                                     args.memory_budget * 2**20 // workers)
+            print(f"Pipeline buffer size for memory budget: {pipeline_options['buffer_size'] // 2**10} KB")
 
     print(f"Extracting zip files in: {zip_root}\nto {output_root}")
-    extract_zip_directory(zip_root, output_root, pool.Pool(), skip_files=skip_files, select_files=select_files)
+    extract_zip_directory(zip_root, output_root, pool.Pool(workers), skip_files=skip_files, select_files=select_files,
+                          include=args.include, exclude=args.exclude, index_members=index_members,
+                          split_size=args.split_size * 2**20, resume=args.resume, pipeline_options=pipeline_options,
+                          telemetry_path=args.telemetry, telemetry_interval=args.telemetry_interval)
     # extract_zip_directory(zip_root, output_root, mpool=None)
 
 
-def extract_zip_directory(zip_root: Path, output_root: Path, mpool: pool.Pool, skip_files: list = None, select_files: list = None):
+def extract_zip_directory(zip_root: Path, output_root: Path, mpool: pool.Pool, skip_files: list = None, select_files: list = None,
+                          include: list = None, exclude: list = None, index_members: dict = None,
+                          split_size: int = default_split_size, resume: bool = False, pipeline_options: dict = None,
+                          telemetry_path=None, telemetry_interval: float = 5.0):
     """
     Workflow for extract zip directory. Index directory to find files first, then run extraction task
 
@@ -74,29 +154,54 @@ def extract_zip_directory(zip_root: Path, output_root: Path, mpool: pool.Pool, s
     zip_root
     output_root
     mpool
+    include
+        Globs of zip members to extract. None extracts all members
+    exclude
+        Globs of zip members not to extract
+    index_members
+        Dict of member paths to extract keyed by zip path relative to zip_root, as returned by query_index_members.
+        Zips not in the dict are skipped, and zip_root is not walked
+    split_size
+        Zip files with more bytes than this to extract are split between workers
+    resume
+        Continue a previous extraction into output_root, skipping members recorded in its manifest
+    pipeline_options
+        Keyword arguments for extraction_pipeline.extract_members, or None to extract members one at a time
+    telemetry_path
+        JSON lines file to append live throughput snapshots to, or None for no telemetry
+    telemetry_interval
+        Seconds between telemetry snapshots
     """
     # Make all the directories first so we don't crash into each other in the pool
     # Search backwards so we make deeper dirs first and can skip shallower ones
-    directory_index = index_directory(zip_root)
+    # With index members, only the directories of the zip files they are in are needed
+    directory_index = index_directory(zip_root) if index_members is None else containers_index(index_members)
     for dirpath, _, _ in directory_index[::-1]:
         if not os.path.exists(output_root / dirpath):
             os.makedirs(output_root / dirpath)
 
-    results = extract_zip_files(zip_root, output_root, directory_index, mpool, skip_files=skip_files, select_files=select_files)
+    results = extract_zip_files(zip_root, output_root, directory_index, mpool, skip_files=skip_files, select_files=select_files,
+                                include=include, exclude=exclude, index_members=index_members, split_size=split_size,
+                                resume=resume, pipeline_options=pipeline_options, telemetry_path=telemetry_path,
+                                telemetry_interval=telemetry_interval)
     failed_files = [(file, exception) for exception, file in results if exception is not None]
     succeeded_files = [str(PurePosixPath(file)) for exception, file in results if exception is None]
 
     if failed_files:
         print(f"Failed to extract: {failed_files}")
-        fname = str(Path(__file__).parent / "test_data" / "succeeded_files.csv")
+        fname = str(output_root / "succeeded_files.csv")
         np.savetxt(fname, np.array(succeeded_files), fmt="%s", delimiter=",")
     else:
         print("All files extracted successfully")
 
 
-def extract_zip_files(zip_root: Path, output_root: Path, directory_index, mpool: pool.Pool, skip_files: list = None, select_files: list=None):
+def extract_zip_files(zip_root: Path, output_root: Path, directory_index, mpool: pool.Pool, skip_files: list = None, select_files: list=None,
+                      include: list = None, exclude: list = None, index_members: dict = None,
+                      split_size: int = default_split_size, resume: bool = False, pipeline_options: dict = None,
+                      telemetry_path=None, telemetry_interval: float = 5.0):
     """
-    Extraction task for workflow. Flatten file list then distribute them to the worker function
+    Extraction task for workflow. Flatten file list, read the central directories to choose members and size the
+    work, then distribute it to the worker function largest first
 
     Parameters
     ----------
@@ -106,33 +211,141 @@ def extract_zip_files(zip_root: Path, output_root: Path, directory_index, mpool:
     mpool
     skip
         list of zip files to skip
+    include
+    exclude
+    index_members
+    split_size
+    resume
+        Skip members recorded in the manifest whose extracted size still matches. Otherwise any previous manifest is
+        discarded
+    pipeline_options
+    telemetry_path
+    telemetry_interval
 
     Returns
     -------
-
+    results
+        List of (exception, zip_file_path), one per zip file
     """
     if skip_files is None:
         skip_files = []
+    # Build the matchers once rather than per zip file
+    select_matcher = SubstringMatcher(select_files) if select_files is not None else None
+    skip_names = {PurePosixPath(str(s)).parts[-1] for s in np.atleast_1d(skip_files)}
+
+    # Each worker appends the members it finishes to its own manifest file, so a crash loses at most the member
+    # being written
+    manifest_directory = Path(output_root) / manifest_directory_name
+    if resume:
+        manifest = load_manifest(manifest_directory)
+    else:
+        manifest = {}
+        if os.path.exists(manifest_directory):
+            shutil.rmtree(manifest_directory)
+    os.makedirs(manifest_directory, exist_ok=True)
+
     # Get a flat list of all the zip files
     files_list = []  # List of tuples with zip path and output path
     for dirpath, _, files in directory_index:
         if len(zip_files := fnmatch.filter(files, "*.zip")) > 0:
             for zip_file in zip_files:
-                if np.any([len(fnmatch.filter([zip_file], f"*{pat}*")) > 0 for pat in select_files]):
-                    if zip_file not in [PurePosixPath(s).parts[-1] for s in skip_files]:
-                        files_list.append((zip_root / dirpath / zip_file, output_root / dirpath))
+                if select_matcher is None or select_matcher(zip_file):
+                    if zip_file not in skip_names:
+                        zip_key = str(PurePosixPath(dirpath) / zip_file)
+                        members = None
+                        if index_members is not None:
+                            if (members := index_members.get(zip_key)) is None:
+                                continue
+                        files_list.append((zip_root / dirpath / zip_file, output_root / dirpath, include, exclude,
+                                           members, zip_key, manifest.get(zip_key)))
 
     if mpool is None:
-        results = []
-        for zip_file, output_directory in tqdm(files_list, desc="Extracting files"):
-            r = extract_zip_file((zip_file, output_directory))
-            results.append(r)
+        plans = [plan_zip_file(task) for task in tqdm(files_list, desc="Reading zip files")]
     else:
-        results_it = tqdm(mpool.imap(extract_zip_file, files_list, chunksize=2), desc="Extracting files",
-                          total=len(files_list))
-        results = list(results_it)
+        plans = list(tqdm(mpool.imap_unordered(plan_zip_file, files_list, chunksize=16), desc="Reading zip files",
+                          total=len(files_list)))
+
+    zip_exceptions = {zip_file_path: exception for exception, zip_file_path, *_ in plans}
+    # Worker processes cannot share a plain queue, so telemetry goes through a manager when there is a pool
+    manager = None
+    telemetry_events = None
+    if telemetry_path is not None:
+        if mpool is None:
+            telemetry_events = queue.Queue()
+        else:
+            manager = multiprocessing.Manager()
+            telemetry_events = manager.Queue()
 
-    return results
+    tasks = schedule_extraction([plan for plan in plans if plan[0] is None], split_size, manifest_directory,
+                                pipeline_options, telemetry_events)
+    total_bytes = sum(task[3] for task in tasks)
+
+    # One task at a time so idle workers take the next largest task as soon as they finish
+    pipeline_stats = extraction_pipeline.PipelineStats()
+    start = time.perf_counter()
+    try:
+        with tqdm(desc="Extracting files", total=total_bytes, unit="B", unit_scale=True) as progress, \
+                (extraction_telemetry.TelemetryMonitor(telemetry_events, telemetry_path, total_bytes,
+                                                       interval=telemetry_interval)
+                 if telemetry_events is not None else contextlib.nullcontext()):
+            if mpool is None:
+                results_it = (extract_zip_file(task) for task in tasks)
+            else:
+                results_it = mpool.imap_unordered(extract_zip_file, tasks, chunksize=1)
+            for exception, zip_file_path, task_bytes, stats in results_it:
+                progress.update(task_bytes)
+                if stats is not None:
+                    pipeline_stats.merge(stats)
+                if zip_exceptions[zip_file_path] is None:
+                    zip_exceptions[zip_file_path] = exception
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+    if pipeline_options is not None:
+        print(f"Pipeline throughput:\n{pipeline_stats.report(time.perf_counter() - start)}")
+
+    return [(zip_exceptions[zip_file_path], zip_file_path) for zip_file_path, *_ in files_list]
+
+
+def schedule_extraction(plans, split_size, *worker_args):
+    """
+    Turn zip file plans into extraction tasks, largest first. Zip files with more than split_size bytes are split
+    into contiguous member ranges so several workers can extract them at once
+
+    Parameters
+    ----------
+    plans
+        List of (exception, zip_file_path, output_directory, members, whole, zip_key) from plan_zip_file
+    split_size
+    worker_args
+        Further arguments of extract_zip_file, the same for every task
+
+    Returns
+    -------
+    tasks
+        List of (zip_file_path, output_directory, members, task_bytes, zip_key, *worker_args). members is None to
+        extract the whole zip
+    """
+    tasks = []
+    for _, zip_file_path, output_directory, members, whole, zip_key in plans:
+        zip_bytes = sum(size for _, size in members)
+        if zip_bytes <= split_size:
+            tasks.append((zip_file_path, output_directory, None if whole else [name for name, _ in members],
+                          zip_bytes, zip_key, *worker_args))
+            continue
+
+        part, part_bytes = [], 0
+        for name, size in members:
+            part.append(name)
+            part_bytes += size
+            if part_bytes >= split_size:
+                tasks.append((zip_file_path, output_directory, part, part_bytes, zip_key, *worker_args))
+                part, part_bytes = [], 0
+        if part:
+            tasks.append((zip_file_path, output_directory, part, part_bytes, zip_key, *worker_args))
+
+    return sorted(tasks, key=lambda task: task[3], reverse=True)
 
 
 def args_unpacker(func):
@@ -146,26 +359,340 @@ def args_unpacker(func):
 
 
 @args_unpacker
-def extract_zip_file(zip_file_path, output_directory):
+def plan_zip_file(zip_file_path, output_directory, include=None, exclude=None, members=None, zip_key=None,
+                  done=None):
     """
-    Worker function for the
+    Worker function reading the central directory of a zip file to choose the members to extract and size them
+
     Parameters
     ----------
     zip_file_path
     output_directory
+    include
+    exclude
+    members
+        See select_members
+    zip_key
+        Path of the zip file relative to zip_root
+    done
+        Dict of [size, crc] keyed by member name for members recorded in the manifest. These are skipped if the
+        extracted file still has the recorded size and the zip member is unchanged
 
     Returns
     -------
+    exception, zip_file_path, output_directory, members, whole, zip_key
+        members is a list of (name, bytes) in zip order, where bytes is the compressed plus uncompressed size.
+        whole is True if every member is selected
+    """
+    exception = None
+    selected = []
+    whole = True
+    try:
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_file:
+            infos = zip_file.infolist()
+            if include is not None or exclude is not None or members is not None:
+                whole = False
+                names = set(select_members([info.filename for info in infos], include, exclude, members))
+                infos = [info for info in infos if info.filename in names]
+            if done:
+                whole = False
+                infos = [info for info in infos if not is_extracted(output_directory, info, done)]
+            selected = [(info.filename, info.compress_size + info.file_size) for info in infos]
+    except Exception as e:
+        exception = e
 
+    return exception, zip_file_path, output_directory, selected, whole, zip_key
+
+
+def is_extracted(output_directory, info: zipfile.ZipInfo, done):
+    """
+    Check whether a zip member recorded in the manifest is still fully extracted
+    """
+    if info.is_dir() or done.get(info.filename) != [info.file_size, info.CRC]:
+        return False
+    try:
+        return os.path.getsize(member_path(output_directory, info.filename)) == info.file_size
+    except OSError:
+        return False
+
+
+@args_unpacker
+def extract_zip_file(zip_file_path, output_directory, members=None, task_bytes=0, zip_key=None,
+                     manifest_directory=None, pipeline_options=None, telemetry_events=None):
+    """
+    Worker function for the
+    Parameters
+    ----------
+    zip_file_path
+    output_directory
+    members
+        List of member names to extract, or None for all
+    task_bytes
+        Size of the task, passed back for progress reporting
+    zip_key
+        Path of the zip file relative to zip_root, recorded in the manifest
+    manifest_directory
+        Directory of manifest files. If None, no manifest is written
+    pipeline_options
+        Keyword arguments for extraction_pipeline.extract_members. If None, members are extracted one at a time
+    telemetry_events
+        Queue for extraction_telemetry.TelemetryReporter, or None for no telemetry
+
+    Returns
+    -------
+    exception, zip_file_path, task_bytes, stats
+        stats is the PipelineStats of the task, or None without the pipeline
     """
     exception = None
+    stats = None
+    manifest_file = None
+    manifest_lock = threading.Lock()
+    reporter = extraction_telemetry.TelemetryReporter(telemetry_events) if telemetry_events is not None else None
+
+    def record(info):
+        if reporter is not None:
+            reporter.member_done(info.compress_size, info.file_size)
+        if manifest_file is not None:
+            with manifest_lock:
+                manifest_file.write(json.dumps({"zip": zip_key, "member": info.filename, "size": info.file_size,
+                                                "crc": info.CRC}) + "\n")
+                manifest_file.flush()
+
     try:
+        if manifest_directory is not None:
+            manifest_file = open(Path(manifest_directory) / f"{os.getpid()}-{threading.get_ident()}.jsonl", "a")
         with zipfile.ZipFile(zip_file_path, 'r') as zip_file:
-            zip_file.extractall(str(output_directory))
+            infos = zip_file.infolist() if members is None else [zip_file.getinfo(name) for name in members]
+            directories = set()
+            if pipeline_options is not None:
+                pipelined = [info for info in infos if extraction_pipeline.is_pipeline_supported(info)]
+                for info in pipelined:
+                    make_member_directory(output_directory, info, directories)
+                stats = extraction_pipeline.extract_members(
+                    zip_file_path, [(info, member_path(output_directory, info.filename)) for info in pipelined],
+                    on_done=record, **pipeline_options)
+                infos = [info for info in infos if not extraction_pipeline.is_pipeline_supported(info)]
+            for info in infos:
+                extract_member(zip_file, info, output_directory, directories)
+                if not info.is_dir():
+                    record(info)
     except Exception as e:
         exception = e
+    finally:
+        if manifest_file is not None:
+            os.fsync(manifest_file.fileno())
+            manifest_file.close()
+        if reporter is not None:
+            reporter.flush()
+
+    return exception, zip_file_path, task_bytes, stats
+
+
+def extract_member(zip_file: zipfile.ZipFile, info: zipfile.ZipInfo, output_directory, directories: set):
+    """
+    Extract one zip member. Data is written to a .part file that is renamed once complete, so a file at the member
+    path is never partially written, and removed if extraction fails
+
+    Parameters
+    ----------
+    zip_file
+    info
+    output_directory
+    directories
+        Set of directories already created by this worker, to avoid repeating makedirs. Other workers may be
+        extracting parts of the same zip file, so directories are always created with exist_ok
+    """
+    target = make_member_directory(output_directory, info, directories)
+    if info.is_dir():
+        return
+
+    part_path = f"{target}.part"
+    try:
+        with zip_file.open(info) as source, open(part_path, "wb") as target_file:
+            shutil.copyfileobj(source, target_file, 2**20)
+        os.replace(part_path, target)
+    except BaseException:
+        extraction_pipeline.remove_part_file(part_path)
+        raise
+
+
+def make_member_directory(output_directory, info: zipfile.ZipInfo, directories: set):
+    """
+    Create the directory a zip member is extracted into (or the member itself, for directories)
+
+    Returns
+    -------
+    target
+        Path the member is extracted to
+    """
+    target = member_path(output_directory, info.filename)
+    directory = target if info.is_dir() else os.path.dirname(target)
+    if directory not in directories:
+        os.makedirs(directory, exist_ok=True)
+        directories.add(directory)
+    return target
+
+
+def member_path(output_directory, name):
+    """
+    Path a zip member is extracted to. Empty, "." and ".." components are dropped, as extractall does, so members
+    cannot be written outside output_directory
+    """
+    parts = [part for part in name.split("/") if part not in ["", ".", ".."]]
+    return os.path.join(str(output_directory), *parts)
+
+
+def load_manifest(manifest_directory):
+    """
+    Load the extraction manifest written by extract_zip_file
+
+    Parameters
+    ----------
+    manifest_directory
+
+    Returns
+    -------
+    manifest
+        Dict keyed by zip path of dicts of [size, crc] keyed by member name. Truncated lines from a crash mid write
+        are ignored
+    """
+    manifest = {}
+    if not os.path.exists(manifest_directory):
+        return manifest
+
+    for manifest_path in Path(manifest_directory).glob("*.jsonl"):
+        with open(manifest_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                manifest.setdefault(entry["zip"], {})[entry["member"]] = [entry["size"], entry["crc"]]
+
+    return manifest
+
+
+def select_members(names, include=None, exclude=None, members=None):
+    """
+    Choose which members of a zip file to extract. Each selected .mhd header brings its .raw/.zraw data file with it,
+    even if the data file would not be selected on its own
+
+    Parameters
+    ----------
+    names
+        Member names of the zip file
+    include
+        Globs matched against the full member path. None selects all members
+    exclude
+        Globs matched against the full member path
+    members
+        Collection of member paths, e.g. from a dataset index query. If given, only these members are selected
+
+    Returns
+    -------
+    selected
+        List of member names, in zip order
+    """
+    include_pattern = compile_globs(include) if include else None
+    exclude_pattern = compile_globs(exclude) if exclude else None
+    if members is not None and not isinstance(members, (set, frozenset)):
+        members = set(members)
+
+    selected = set()
+    for name in names:
+        if members is not None and name not in members:
+            continue
+        if include_pattern is not None and not include_pattern.match(name):
+            continue
+        if exclude_pattern is not None and exclude_pattern.match(name):
+            continue
+        selected.add(name)
+
+    name_set = set(names)
+    for name in list(selected):
+        stem, suffix = posixpath.splitext(name)
+        if suffix == ".mhd":
+            selected.update(companion for companion in [stem + ".raw", stem + ".zraw"] if companion in name_set)
+
+    return [name for name in names if name in selected]
+
+
+class SubstringMatcher:
+    """
+    Matches file names containing any of a list of patterns, equivalent to fnmatch with *pattern* for each one.
+    Plain patterns (e.g. subject IDs) are looked up in a set for each substring length they could have, so the
+    cost per name does not grow with the number of patterns. Patterns containing glob characters are combined
+    into one regex.
+    """
+    glob_characters = re.compile(r"[*?[]")
+
+    def __init__(self, patterns):
+        patterns = [str(pattern) for pattern in np.atleast_1d(patterns)]
+        self.literals = {pattern for pattern in patterns if not self.glob_characters.search(pattern)}
+        self.lengths = sorted({len(pattern) for pattern in self.literals})
+        globs = [pattern for pattern in patterns if self.glob_characters.search(pattern)]
+        self.glob_pattern = compile_globs([f"*{pattern}*" for pattern in globs]) if globs else None
+
+    def __call__(self, name):
+        for length in self.lengths:
+            if length > len(name):
+                break
+            for i in range(len(name) - length + 1):
+                if name[i:i + length] in self.literals:
+                    return True
+
+        return self.glob_pattern is not None and self.glob_pattern.match(name) is not None
+
+
+def compile_globs(patterns):
+    """
+    Combine fnmatch style globs into one compiled regex
+    """
+    return re.compile("|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns))
+
+
+def query_index_members(index_path, criteria: dict):
+    """
+    Find the zip members to extract from a dataset index
+
+    Parameters
+    ----------
+    index_path
+        Index written by index_zip_folder with --format parquet (a .parquet file) or --format sqlite
+    criteria
+        Dict of subject, phase, inex and/or suffix to match
+
+    Returns
+    -------
+    index_members
+        Dict of sets of member paths keyed by zip path relative to the indexed directory
+    """
+    from index_zip_folder import query_parquet_index, query_sqlite_index
+
+    query = query_parquet_index if Path(index_path).suffix == ".parquet" else query_sqlite_index
+    files = query(index_path, columns=["container", "dirpath", "name"], **criteria)
+    index_members = {}
+    for container, dirpath, name in zip(files["container"], files["dirpath"], files["name"]):
+        if not container:
+            continue
+        member = name if dirpath == "." else f"{dirpath}/{name}"
+        index_members.setdefault(container, set()).add(member)
+
+    return index_members
+
+
+def containers_index(index_members):
+    """
+    Directory index, as from index_directory, listing only the zip files of index_members. Members of zip files
+    nested in other zip files are left out, as only zip files on disk are extracted
+    """
+    directories = {}
+    for zip_key in index_members:
+        zip_key = PurePosixPath(zip_key)
+        if not any(part.lower().endswith(".zip") for part in zip_key.parent.parts):
+            directories.setdefault(zip_key.parent, []).append(zip_key.name)
 
-    return exception, zip_file_path
+    return [[dirpath, [], files] for dirpath, files in directories.items()]
 
 
 def index_directory(directory, show_progress=True):
@@ -0,0 +1,290 @@
+import os
+import queue
+import struct
+import threading
+import time
+import zipfile
+import zlib
+
+"""
+Pipelined extraction of zip members. Reader threads make large sequential reads of each member's compressed data,
+decompression threads inflate it and writer threads write it out, all connected by bounded queues so a slow stage
+holds back the stages before it instead of buffering without limit. zlib releases the GIL, so the stages run in
+parallel within one process.
+"""
+
+default_buffer_size = 4 * 2**20
+end_of_stream = object()
+
+
+class MemberStream:
+    """
+    Chunks of one zip member passed between two stages, in order
+    """
+
+    def __init__(self, info: zipfile.ZipInfo, target, queue_depth):
+        self.info = info
+        self.target = target
+        self.chunks = queue.Queue(queue_depth)
+
+
+class PipelineStats:
+    """
+    Bytes handled and seconds spent working (not waiting on queues) in each stage, summed over the stage's threads
+    """
+    stages = ["read", "inflate", "write"]
+
+    def __init__(self):
+        self.bytes = {stage: 0 for stage in self.stages}
+        self.seconds = {stage: 0.0 for stage in self.stages}
+        self.wall_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, stage, n_bytes, seconds):
+        with self.lock:
+            self.bytes[stage] += n_bytes
+            self.seconds[stage] += seconds
+
+    def merge(self, other):
+        for stage in self.stages:
+            self.add(stage, other.bytes[stage], other.seconds[stage])
+        self.wall_seconds += other.wall_seconds
+
+    def report(self, wall_seconds=None):
+        """
+        Throughput of each stage in MB/s, over wall_seconds (defaults to the time spent in pipelines) and per busy
+        thread
+        """
+        wall_seconds = wall_seconds if wall_seconds is not None else self.wall_seconds
+        lines = []
+        for stage in self.stages:
+            overall = self.bytes[stage] / 1e6 / wall_seconds if wall_seconds > 0 else 0
+            per_thread = self.bytes[stage] / 1e6 / self.seconds[stage] if self.seconds[stage] > 0 else 0
+            lines.append(f"{stage}: {self.bytes[stage] / 1e6:.1f} MB, {overall:.1f} MB/s, "
+                         f"{per_thread:.1f} MB/s per busy thread")
+        return "\n".join(lines)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def is_pipeline_supported(info: zipfile.ZipInfo):
+    """
+    Whether a member can go through the pipeline. Only unencrypted stored and deflated files are supported
+    """
+    return (not info.is_dir() and not info.flag_bits & 0x1
+            and info.compress_type in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+
+
+def fit_memory_budget(pipeline_options, memory_budget):
+    """
+    Choose the buffer size so a pipeline's buffers fit in a memory budget. Each member stream holds up to
+    queue_depth buffers, and up to queue_depth streams can wait between stages on top of those being worked on, so
+    the pipeline holds at most buffer_size * queue_depth * (2 * queue_depth + inflate_threads + write_threads)
+
+    Parameters
+    ----------
+    pipeline_options
+        Keyword arguments for extract_members
+    memory_budget
+        Bytes available to one pipeline
+
+    Returns
+    -------
+    pipeline_options
+        Copy of pipeline_options with buffer_size set, no smaller than 64 KB
+    """
+    options = {"inflate_threads": 2, "write_threads": 2, "queue_depth": 8}
+    options.update(pipeline_options)
+    buffers = options["queue_depth"] * (2 * options["queue_depth"] + options["inflate_threads"]
+                                        + options["write_threads"])
+    options["buffer_size"] = max(memory_budget // buffers, 64 * 2**10)
+    return options
+
+
+def extract_members(zip_file_path, members, on_done=None, read_threads=2, inflate_threads=2, write_threads=2,
+                    buffer_size=default_buffer_size, queue_depth=8):
+    """
+    Extract zip members through the read, inflate and write pipeline. Each member is written to a .part file that
+    is renamed once complete and its CRC checked. The first error stops the pipeline and is raised.
+
+    Parameters
+    ----------
+    zip_file_path
+    members
+        List of (info, target path) for members accepted by is_pipeline_supported. Target directories must exist
+    on_done
+        Called with the ZipInfo of each member once it is in place, from a writer thread
+    read_threads
+    inflate_threads
+    write_threads
+        Number of threads in each stage
+    buffer_size
+        Size of reads and the most decompressed data produced from one chunk
+    queue_depth
+        Number of chunks or members that can wait between two stages
+
+    Returns
+    -------
+    stats
+        PipelineStats
+    """
+    stats = PipelineStats()
+    member_queue = queue.Queue()
+    for member in members:
+        member_queue.put(member)
+    inflate_queue = queue.Queue(queue_depth)
+    write_queue = queue.Queue(queue_depth)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def read():
+        with open(zip_file_path, "rb", buffering=0) as f:
+            while not stop.is_set():
+                try:
+                    info, target = member_queue.get_nowait()
+                except queue.Empty:
+                    return
+                stream = MemberStream(info, target, queue_depth)
+                if not put(inflate_queue, stream):
+                    return
+                f.seek(member_data_offset(f, info))
+                remaining = info.compress_size
+                while remaining > 0:
+                    start = time.perf_counter()
+                    chunk = f.read(min(buffer_size, remaining))
+                    stats.add("read", len(chunk), time.perf_counter() - start)
+                    if not chunk:
+                        raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+                    remaining -= len(chunk)
+                    if not put(stream.chunks, chunk):
+                        return
+                put(stream.chunks, end_of_stream)
+
+    def inflate():
+        while (stream := get(inflate_queue)) is not None and stream is not end_of_stream:
+            output = MemberStream(stream.info, stream.target, queue_depth)
+            if not put(write_queue, output):
+                return
+            decompressor = zlib.decompressobj(-15) if stream.info.compress_type == zipfile.ZIP_DEFLATED else None
+            while (chunk := get(stream.chunks)) is not end_of_stream:
+                if chunk is None:
+                    return
+                if decompressor is None:
+                    stats.add("inflate", len(chunk), 0.0)
+                    if not put(output.chunks, chunk):
+                        return
+                    continue
+                # Limit the output of each call so highly compressed members do not balloon in memory
+                while chunk:
+                    start = time.perf_counter()
+                    data = decompressor.decompress(chunk, buffer_size)
+                    stats.add("inflate", len(data), time.perf_counter() - start)
+                    if data and not put(output.chunks, data):
+                        return
+                    chunk = decompressor.unconsumed_tail
+            if decompressor is not None and (tail := decompressor.flush()):
+                put(output.chunks, tail)
+            put(output.chunks, end_of_stream)
+
+    def write():
+        while (stream := get(write_queue)) is not None and stream is not end_of_stream:
+            part_path = f"{stream.target}.part"
+            crc = 0
+            complete = False
+            try:
+                with open(part_path, "wb") as f:
+                    while (chunk := get(stream.chunks)) is not end_of_stream:
+                        if chunk is None:
+                            return
+                        start = time.perf_counter()
+                        f.write(chunk)
+                        crc = zlib.crc32(chunk, crc)
+                        stats.add("write", len(chunk), time.perf_counter() - start)
+                if crc != stream.info.CRC:
+                    raise zipfile.BadZipFile(f"Bad CRC-32 for file {stream.info.filename}")
+                os.replace(part_path, stream.target)
+                complete = True
+            finally:
+                # Members that fail, or are stopped by an error elsewhere in the pipeline, leave no .part file
+                if not complete:
+                    remove_part_file(part_path)
+            if on_done is not None:
+                on_done(stream.info)
+
+    def run(stage):
+        try:
+            stage()
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def start_threads(stage, n_threads):
+        threads = [threading.Thread(target=run, args=(stage,), daemon=True) for _ in range(max(n_threads, 1))]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    start = time.perf_counter()
+    readers = start_threads(read, read_threads)
+    inflaters = start_threads(inflate, inflate_threads)
+    writers = start_threads(write, write_threads)
+
+    # Shut each stage down once the stage feeding it has finished
+    for stage_threads, next_queue, next_threads in [(readers, inflate_queue, inflaters),
+                                                    (inflaters, write_queue, writers), (writers, None, [])]:
+        for thread in stage_threads:
+            thread.join()
+        for _ in next_threads:
+            put(next_queue, end_of_stream)
+    stats.wall_seconds = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+    return stats
+
+
+def remove_part_file(part_path):
+    """
+    Remove a partly written member, if it exists
+    """
+    try:
+        os.remove(part_path)
+    except FileNotFoundError:
+        pass
+
+
+def member_data_offset(f, info: zipfile.ZipInfo):
+    """
+    Offset of a member's data in the zip file, after its local file header
+    """
+    f.seek(info.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+    if header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
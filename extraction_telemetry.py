@@ -0,0 +1,133 @@
+import json
+import os
+import queue
+import threading
+import time
+
+"""
+Live throughput telemetry for zip extraction. Workers report the bytes and files they finish through a queue, and a
+monitor thread in the main process aggregates them into JSON lines snapshots that can be followed while a run is in
+progress.
+"""
+
+
+class TelemetryReporter:
+    """
+    Worker side of the telemetry. Counts finished members and busy time, and sends them to the monitor at most once
+    per interval. Safe to call from several threads of one worker.
+    """
+
+    def __init__(self, events, interval=0.5):
+        self.events = events
+        self.interval = interval
+        self.worker = f"{os.getpid()}-{threading.get_ident()}"
+        self.lock = threading.Lock()
+        self.reset(time.perf_counter())
+
+    def reset(self, now):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.files = 0
+        self.last_flush = now
+
+    def member_done(self, bytes_in, bytes_out):
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.files += 1
+            if time.perf_counter() - self.last_flush >= self.interval:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        now = time.perf_counter()
+        self.events.put((self.worker, self.bytes_in, self.bytes_out, self.files, now - self.last_flush))
+        self.reset(now)
+
+
+class TelemetryMonitor:
+    """
+    Main process side of the telemetry. Every interval, appends a snapshot with cumulative and per second bytes in
+    (compressed, read) and out (uncompressed, written), files per second, the utilisation of each worker over the
+    interval and an ETA from the bytes remaining.
+    """
+
+    def __init__(self, events, telemetry_path, total_bytes, interval=5.0):
+        """
+        Parameters
+        ----------
+        events
+            Queue the workers' TelemetryReporters send to
+        telemetry_path
+            JSON lines file to append snapshots to
+        total_bytes
+            Bytes in plus bytes out expected for the whole run, for the ETA
+        interval
+            Seconds between snapshots
+        """
+        self.events = events
+        self.telemetry_path = telemetry_path
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.totals = {"bytes_in": 0, "bytes_out": 0, "files": 0}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        with open(self.telemetry_path, "a") as f:
+            last_snapshot = time.perf_counter()
+            while True:
+                stopping = self.stop_event.is_set()
+                interval_totals = {"bytes_in": 0, "bytes_out": 0, "files": 0}
+                busy = {}
+                deadline = last_snapshot + self.interval
+                while (remaining := deadline - time.perf_counter()) > 0 or stopping:
+                    try:
+                        worker, bytes_in, bytes_out, files, busy_seconds = self.events.get(
+                            timeout=max(remaining, 0) if not stopping else 0)
+                    except queue.Empty:
+                        break
+                    interval_totals["bytes_in"] += bytes_in
+                    interval_totals["bytes_out"] += bytes_out
+                    interval_totals["files"] += files
+                    busy[worker] = busy.get(worker, 0.0) + busy_seconds
+
+                now = time.perf_counter()
+                f.write(json.dumps(self.snapshot(now, now - last_snapshot, interval_totals, busy)) + "\n")
+                f.flush()
+                last_snapshot = now
+                if stopping:
+                    return
+
+    def snapshot(self, now, seconds, interval_totals, busy):
+        for key, value in interval_totals.items():
+            self.totals[key] += value
+        elapsed = now - self.start
+        done_bytes = self.totals["bytes_in"] + self.totals["bytes_out"]
+        rate = done_bytes / elapsed if elapsed > 0 else 0
+        seconds = max(seconds, 1e-9)
+
+        return {
+            "time": time.time(),
+            "elapsed": elapsed,
+            "bytes_in": self.totals["bytes_in"],
+            "bytes_out": self.totals["bytes_out"],
+            "files": self.totals["files"],
+            "bytes_in_per_s": interval_totals["bytes_in"] / seconds,
+            "bytes_out_per_s": interval_totals["bytes_out"] / seconds,
+            "files_per_s": interval_totals["files"] / seconds,
+            "worker_utilisation": {worker: min(busy_seconds / seconds, 1.0) for worker, busy_seconds in busy.items()},
+            "eta_seconds": (self.total_bytes - done_bytes) / rate if rate > 0 else None,
+        }
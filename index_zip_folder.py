@@ -1,85 +1,893 @@
 import argparse
-import tkinter as tk
-from tkinter.filedialog import askdirectory
+import cli_prompts
 import os
 from pathlib import Path, PurePosixPath
 from tqdm import tqdm
-import pandas as pd
 import zipfile
+from multiprocessing import pool
+import functools
+import json
+import posixpath
+import re
+import sqlite3
+import io
+import struct
 """
 Script to create an index of a folder with multiple zip files
 """
 
+subject_pattern = re.compile(r"^(\d{5}[A-Z])(?=[_.]|$)")
+phase_pattern = re.compile(r"(?:^|/)(COPD\d)(?=/|$)")
+inex_pattern = re.compile(r"_(INSP|EXP)(?=_|\.|$)")
+
+default_member_memory_cap = 256 * 2**20
+
 
 def run_cli():
     output_directory = Path("output")
-    index_filename = "directory_index.csv"
+    index_filenames = {"tsv": "directory_index.csv", "parquet": "directory_index.parquet",
+                       "sqlite": "directory_index.sqlite"}
+    journal_filename = "directory_index_journal.jsonl"
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--root", help="Root", type=str)
+    parser.add_argument("--workers", help="Number of workers reading zip files in parallel", type=int)
+    parser.add_argument("--use_processes", help="Use a process pool rather than a thread pool for the workers",
+                        default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--journal", help="Checkpoint journal of indexed zip files, used to resume an interrupted run",
+                        type=str)
+    parser.add_argument("--incremental", help="Only re-read zip files added or changed since the previous index",
+                        default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument("--format", help="Index format. tsv has one row per directory with stringified file lists, "
+                                         "parquet has one row per file, sqlite has one row per file with indexed "
+                                         "subject, phase, inex and suffix columns",
+                        choices=["tsv", "parquet", "sqlite"], default="tsv")
+    parser.add_argument("--nested_depth", help="How many levels of zip files inside zip files to index", type=int,
+                        default=0)
+    parser.add_argument("--nested_memory_cap", help="Largest compressed inner zip file (MB) to buffer in memory. "
+                                                    "Stored inner zip files are read in place at any size",
+                        type=int, default=default_member_memory_cap // 2**20)
+    cli_prompts.add_interactive_argument(parser)
     args = parser.parse_args()
 
     if args.root is not None:
         root = Path(args.root)
     else:
-        tk.Tk().withdraw()
-        if not (root := askdirectory(title="Select root directory")):
+        if not cli_prompts.is_interactive(args):
+            parser.error("--root is required when not interactive")
+        if not (root := cli_prompts.ask_directory("Select root directory")):
             exit()
         root = Path(root)
 
-    print(f"Indexing directory: {str(root)}")
-    directory_walk = index_directory(root)
-
-    index_path = output_directory / index_filename
-
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
 
+    journal_path = args.journal
+    if args.incremental and journal_path is None:
+        journal_path = output_directory / journal_filename
+
+    index_path = output_directory / index_filenames[args.format]
+    nested_options = {"max_depth": args.nested_depth, "member_memory_cap": args.nested_memory_cap * 2**20}
+
+    print(f"Indexing directory: {str(root)}")
+    if args.format in ["parquet", "sqlite"]:
+        files = index_directory_files(root, journal_path=journal_path, workers=args.workers,
+                                      use_processes=args.use_processes, prune_journal=args.incremental,
+                                      **nested_options)
+        if args.format == "parquet":
+            write_index(files, index_path)
+        else:
+            write_sqlite_index(files, index_path)
+        return
+
+    if args.workers is not None or journal_path is not None:
+        directory_walk = index_directory_parallel(root, journal_path=journal_path, workers=args.workers,
+                                                  use_processes=args.use_processes, prune_journal=args.incremental,
+                                                  **nested_options)
+    else:
+        directory_walk = index_directory(root, **nested_options)
+
+    import pandas as pd
     pd.DataFrame(directory_walk).to_csv(index_path, header=["dirpath", "dirnames", "files"], sep="\t", index=False)
 
 
-def index_directory(directory, show_progress=True):
+def write_index(files, index_path):
+    """
+    Write a file index from index_directory_files as parquet. Requires pyarrow
+
+    Parameters
+    ----------
+    files
+    index_path
+    """
+    import pandas as pd
+    index = pd.DataFrame(files, columns=["dirpath", "container", "name", "size", "compressed_size", "crc"])
+    index = index.astype({"dirpath": "category", "container": "category", "size": "int64",
+                          "compressed_size": "int64", "crc": "UInt32"})
+    index.to_parquet(index_path, index=False)
+
+
+def write_sqlite_index(files, index_path):
+    """
+    Write a file index from index_directory_files to a SQLite database, with the COPDGene subject, phase, inex and
+    file suffix parsed into indexed columns. The database uses write ahead logging, and the previous contents are
+    replaced in a single transaction, so readers can keep querying the old index while it is rewritten.
+
+    Parameters
+    ----------
+    files
+    index_path
+    """
+    connection = sqlite3.connect(str(index_path))
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS files (dirpath TEXT, container TEXT, name TEXT, "
+                               "size INTEGER, compressed_size INTEGER, crc INTEGER, subject TEXT, phase TEXT, "
+                               "inex TEXT, suffix TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS files_suffix_phase_inex "
+                               "ON files (suffix, phase, inex, subject)")
+            connection.execute("CREATE INDEX IF NOT EXISTS files_subject ON files (subject, phase, inex)")
+            connection.execute("DELETE FROM files")
+            connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (file + parse_copdgene_file(file[0], file[2]) for file in files))
+    finally:
+        connection.close()
+
+
+def parse_copdgene_file(dirpath, name):
+    """
+    Parse the COPDGene subject, phase, inex and file suffix of an indexed file
+
+    Parameters
+    ----------
+    dirpath
+        Directory of the file, e.g. 10001A/COPD1/10001A_INSP_STD_NJC_COPD
+    name
+        File name, e.g. 10001A_INSP_STD_NJC_COPD_Lobes.mhd or 10001A.zip
+
+    Returns
+    -------
+    subject, phase, inex, suffix
+        Each is None if it cannot be parsed. The suffix is the part of the name after the last underscore
+        (e.g. Lobes.mhd), or the extension if the name has no underscore (e.g. .zip)
+    """
+    subject = match.group(1) if (match := subject_pattern.match(name)) else None
+    phase = matches[-1] if (matches := phase_pattern.findall(str(dirpath))) else None
+    inex = match.group(1) if (match := inex_pattern.search(name)) else None
+    suffix = name.rsplit("_", 1)[1] if "_" in name else posixpath.splitext(name)[1] or None
+    return [subject, phase, inex, suffix]
+
+
+def query_sqlite_index(index_path, subject=None, phase=None, inex=None, suffix=None, columns=None):
+    """
+    Query a SQLite index written by write_sqlite_index, e.g. suffix="Lobes.mhd", phase="COPD1", inex="EXP" to find
+    the EXP lobe segmentations in COPD1. The database is opened read only.
+
+    Parameters
+    ----------
+    index_path
+    subject
+    phase
+    inex
+    suffix
+        Criteria to match exactly. None matches anything
+    columns
+        Columns to return, or None for all
+
+    Returns
+    -------
+    files
+        DataFrame of matching files
+    """
+    criteria = {"subject": subject, "phase": phase, "inex": inex, "suffix": suffix}
+    criteria = {column: value for column, value in criteria.items() if value is not None}
+    query = f"SELECT {', '.join(columns) if columns is not None else '*'} FROM files"
+    if criteria:
+        query += " WHERE " + " AND ".join(f"{column} = ?" for column in criteria)
+
+    import pandas as pd
+    connection = sqlite3.connect(f"{Path(index_path).absolute().as_uri()}?mode=ro", uri=True)
+    try:
+        return pd.read_sql_query(query, connection, params=list(criteria.values()))
+    finally:
+        connection.close()
+
+
+def query_parquet_index(index_path, subject=None, phase=None, inex=None, suffix=None, columns=None):
+    """
+    Query a parquet index written by write_index with the same criteria as query_sqlite_index. Names are first
+    narrowed with vectorised string tests, and only the remaining files are parsed with parse_copdgene_file
+
+    Parameters
+    ----------
+    index_path
+    subject
+    phase
+    inex
+    suffix
+        Criteria to match exactly. None matches anything
+    columns
+        Columns to return, from those of the index and subject, phase, inex and suffix, or None for all
+
+    Returns
+    -------
+    files
+        DataFrame of matching files
+    """
+    parsed_columns = ["subject", "phase", "inex", "suffix"]
+    index_columns = None if columns is None else list(dict.fromkeys(
+        ["dirpath", "name", *[column for column in columns if column not in parsed_columns]]))
+    files = load_index(index_path, columns=index_columns)
+
+    # Necessary conditions for each criterion, cheap to test on every name
+    names = files["name"]
+    match = names.notna()
+    if subject is not None:
+        match &= names.str.startswith(subject)
+    if inex is not None:
+        match &= names.str.contains(f"_{inex}", regex=False)
+    if suffix is not None:
+        match &= names.str.endswith(suffix)
+    files = files[match.to_numpy()]
+
+    parsed = [parse_copdgene_file(dirpath, name) for dirpath, name in zip(files["dirpath"], files["name"])]
+    files = files.assign(**{column: [p[i] for p in parsed] for i, column in enumerate(parsed_columns)})
+    criteria = {"subject": subject, "phase": phase, "inex": inex, "suffix": suffix}
+    for column, value in criteria.items():
+        if value is not None:
+            files = files[files[column] == value]
+
+    return files.reset_index(drop=True)[columns] if columns is not None else files.reset_index(drop=True)
+
+
+def index_directory(directory, show_progress=True, max_depth=0, member_memory_cap=default_member_memory_cap):
     directory_walk = []
     for i, (dirpath, dirnames, files) in tqdm(enumerate(os.walk(directory)), disable=not show_progress):
         directory_walk.append([PurePosixPath(Path(dirpath).relative_to(directory)), dirnames, files])
         for file in files:
             if Path(file).suffix == ".zip":
-                zipwalk_list = list(zipwalk(Path(dirpath) / file))
-                for item in zipwalk_list:
-                    directory_walk.append([item[0], item[1], item[2]])
+                directory_walk.extend(zipwalk(Path(dirpath) / file, max_depth=max_depth,
+                                              member_memory_cap=member_memory_cap))
 
     return directory_walk
 
 
-# Mimic os.walk() function for zipfiles
-def zipwalk(file: Path):
-
-    zfile = zipfile.ZipFile(str(file))
-    # Initialize database
-    dlistdb = {}
-    # Walk through zip file information list
-    for info in zfile.infolist():
-        if info.is_dir():
-            zpath = Path(info.filename).parent
-            zfile = Path(info.filename).name
-            if zpath in dlistdb:
-                dlistdb[zpath][0].append(zfile)
+def index_directory_parallel(directory, journal_path=None, workers=None, use_processes=False, prune_journal=False,
+                             show_progress=True, max_depth=0, member_memory_cap=default_member_memory_cap):
+    """
+    Index a directory, reading the zip files in a worker pool and recording each finished zip in a checkpoint journal.
+    Zips whose size and mtime match their journal entry are not opened again, so an interrupted run can be resumed
+    by passing the same journal.
+
+    Parameters
+    ----------
+    directory
+    journal_path
+        JSON lines file of indexed zip files. If None, no checkpointing is done
+    workers
+        Number of workers. Defaults to the number of cpus
+    use_processes
+        Use a process pool rather than a thread pool. Reading central directories is mostly I/O bound, so threads
+        are usually enough
+    prune_journal
+        Rewrite the journal at the end of the run so it only holds the zip files currently in the directory. This
+        lets the journal be kept between runs as the state of an incremental index
+    show_progress
+    max_depth
+        How many levels of zip files inside zip files to index. Inner zips are read without extracting them
+    member_memory_cap
+        Largest compressed inner zip (bytes) to buffer in memory. Stored inner zips are read in place at any size,
+        larger compressed ones are indexed as plain files
+
+    Returns
+    -------
+    directory_walk
+        List of [dirpath, dirnames, files] in the same order as index_directory
+    """
+    directory = Path(directory)
+    walk = walk_directory(directory, show_progress=show_progress)
+    zip_entries = index_zips(directory, [zip_path for _, zips in walk for zip_path in zips], journal_path=journal_path,
+                             workers=workers, use_processes=use_processes, prune_journal=prune_journal,
+                             show_progress=show_progress, max_depth=max_depth, member_memory_cap=member_memory_cap)
+
+    directory_walk = []
+    for row, zips in walk:
+        directory_walk.append(row)
+        for zip_path in zips:
+            if (entry := zip_entries.get(key := str(PurePosixPath(zip_path.relative_to(directory))))) is not None:
+                for _, members in nested_members(entry, key):
+                    directory_walk.extend(members_walk(members))
+
+    return directory_walk
+
+
+def index_directory_files(directory, journal_path=None, workers=None, use_processes=False, prune_journal=False,
+                          show_progress=True, max_depth=0, member_memory_cap=default_member_memory_cap):
+    """
+    Index a directory with one record per file, including the members of zip files. Zip files are read as in
+    index_directory_parallel.
+
+    Parameters
+    ----------
+    directory
+    journal_path
+    workers
+    use_processes
+    prune_journal
+    show_progress
+    max_depth
+    member_memory_cap
+
+    Returns
+    -------
+    files
+        List of [dirpath, container, name, size, compressed_size, crc]. For zip members, dirpath is the directory
+        within the zip and container is the path of the zip file relative to the indexed directory (followed by the
+        member path for zips inside zips). For files on
+        disk, container is empty, compressed_size is the size and crc is None
+    """
+    directory = Path(directory)
+    walk = walk_directory(directory, show_progress=show_progress)
+    zip_entries = index_zips(directory, [zip_path for _, zips in walk for zip_path in zips], journal_path=journal_path,
+                             workers=workers, use_processes=use_processes, prune_journal=prune_journal,
+                             show_progress=show_progress, max_depth=max_depth, member_memory_cap=member_memory_cap)
+
+    files = []
+    for (dirpath, _, filenames), zips in walk:
+        for file in filenames:
+            size = os.stat(directory / dirpath / file).st_size
+            files.append([str(dirpath), "", file, size, size, None])
+        for zip_path in zips:
+            key = str(PurePosixPath(zip_path.relative_to(directory)))
+            if (entry := zip_entries.get(key)) is None:
+                continue
+            for container, members in nested_members(entry, key):
+                for filename, size, compressed_size, crc in members:
+                    if filename.endswith("/"):
+                        continue
+                    member_dir, name = posixpath.split(filename)
+                    files.append([member_dir or ".", container, name, size, compressed_size, crc])
+
+    return files
+
+
+def walk_directory(directory: Path, show_progress=True):
+    """
+    Walk the file system, remembering which zip files belong after each row
+
+    Parameters
+    ----------
+    directory
+    show_progress
+
+    Returns
+    -------
+    walk
+        List of ([dirpath, dirnames, files], zip_paths)
+    """
+    walk = []
+    for dirpath, dirnames, files in tqdm(os.walk(directory), desc="Indexing directory", disable=not show_progress):
+        zips = [Path(dirpath) / file for file in files if Path(file).suffix == ".zip"]
+        walk.append(([PurePosixPath(Path(dirpath).relative_to(directory)), dirnames, files], zips))
+
+    return walk
+
+
+def index_zips(directory: Path, zip_paths, journal_path=None, workers=None, use_processes=False, prune_journal=False,
+               show_progress=True, max_depth=0, member_memory_cap=default_member_memory_cap):
+    """
+    Read the central directories of zip files in a worker pool, skipping zips that are unchanged in the journal
+
+    Parameters
+    ----------
+    directory
+    zip_paths
+    journal_path
+    workers
+    use_processes
+    prune_journal
+    show_progress
+    max_depth
+    member_memory_cap
+
+    Returns
+    -------
+    zip_entries
+        Dict of journal records keyed by zip path relative to directory. Zips that failed to read are left out
+    """
+    journal = load_journal(journal_path) if journal_path is not None else {}
+    mpool = pool.Pool(workers) if use_processes else pool.ThreadPool(workers)
+    try:
+        stats = mpool.map(os.stat, zip_paths, chunksize=64)
+
+        zip_entries = {}
+        tasks = []
+        for zip_path, stat in zip(zip_paths, stats):
+            key = str(PurePosixPath(zip_path.relative_to(directory)))
+            entry = journal.get(key)
+            # Entries without members come from journals written before member details were recorded
+            if (entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+                    and "members" in entry and entry.get("max_depth", 0) == max_depth):
+                zip_entries[key] = entry
             else:
-                dlistdb[zpath] = [[zfile], []]
+                tasks.append((zip_path, key, stat.st_size, stat.st_mtime_ns, max_depth, member_memory_cap))
+
+        if show_progress and zip_entries:
+            print(f"Skipping {len(zip_entries)} unchanged zip files from journal")
+
+        failed_files = []
+        journal_file = open(journal_path, "a") if journal_path is not None else None
+        try:
+            for exception, key, entry in tqdm(mpool.imap_unordered(index_zip, tasks), desc="Indexing zip files",
+                                              total=len(tasks), disable=not show_progress):
+                if exception is not None:
+                    failed_files.append((key, exception))
+                    continue
+                zip_entries[key] = entry
+                if journal_file is not None:
+                    journal_file.write(json.dumps(entry) + "\n")
+                    journal_file.flush()
+        finally:
+            if journal_file is not None:
+                journal_file.close()
+    finally:
+        mpool.close()
+        mpool.join()
+
+    if failed_files:
+        print(f"Failed to index: {failed_files}")
+
+    if journal_path is not None and prune_journal:
+        # Zips that were deleted since the last run are dropped here
+        write_journal(journal_path, zip_entries.values())
+
+    return zip_entries
+
+
+def args_unpacker(func):
+    """Decorator for multiprocessing methods."""
+
+    def unpack(args):
+        return func(*args)
+
+    functools.update_wrapper(unpack, func)
+    return unpack
+
+
+@args_unpacker
+def index_zip(zip_path, key, size, mtime, max_depth, member_memory_cap):
+    """
+    Worker function for index_zips
+
+    Parameters
+    ----------
+    zip_path
+    key
+        Path of the zip file relative to the indexed directory
+    size
+        Size of the zip file when it was queued
+    mtime
+        Modification time of the zip file in ns when it was queued
+    max_depth
+    member_memory_cap
+
+    Returns
+    -------
+    exception, key, entry
+        entry is the journal record for the zip file, None on failure
+    """
+    exception = None
+    entry = None
+    try:
+        entry = {"zip": key, "size": size, "mtime": mtime, "max_depth": max_depth}
+        entry.update(zip_members(zip_path, max_depth=max_depth, member_memory_cap=member_memory_cap))
+    except Exception as e:
+        exception = e
+
+    return exception, key, entry
+
+
+def load_journal(journal_path):
+    """
+    Load a checkpoint journal written by index_directory_parallel
+
+    Parameters
+    ----------
+    journal_path
+
+    Returns
+    -------
+    journal
+        Dict of journal records keyed by zip path. Later records replace earlier ones, and a truncated final line
+        (from a crash mid write) is ignored
+    """
+    journal = {}
+    if not os.path.exists(journal_path):
+        return journal
+
+    with open(journal_path, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            journal[entry["zip"]] = entry
+
+    return journal
+
+
+def write_journal(journal_path, entries):
+    """
+    Replace a checkpoint journal with the given records. The new journal is written to a temporary file first so a
+    crash never leaves a half written journal behind
+
+    Parameters
+    ----------
+    journal_path
+    entries
+        Iterable of journal records
+    """
+    tmp_path = f"{journal_path}.tmp"
+    with open(tmp_path, "w") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def zip_members(zip_path, max_depth=0, member_memory_cap=default_member_memory_cap):
+    """
+    Read the member details of a zip file from its central directory
+
+    Parameters
+    ----------
+    zip_path
+    max_depth
+        How many levels of zip files inside the zip file to read
+    member_memory_cap
+
+    Returns
+    -------
+    zip_members
+        Dict with "members", a list of [filename, size, compressed_size, crc] where directory members keep their
+        trailing slash, and "nested", a dict of the same for each inner zip keyed by its member name
+    """
+    with zipfile.ZipFile(str(zip_path)) as zfile:
+        return zipfile_members(zfile, max_depth, member_memory_cap)
+
+
+def zipfile_members(zfile: zipfile.ZipFile, max_depth, member_memory_cap):
+    """
+    Read the member details of an open zip file, as zip_members does for a path
+
+    Parameters
+    ----------
+    zfile
+    max_depth
+        How many levels of zip files inside the zip file to read
+    member_memory_cap
+
+    Returns
+    -------
+    zip_members
+        Dict with "members" and "nested", as returned by zip_members
+    """
+    members = [[info.filename, info.file_size, info.compress_size, info.CRC] for info in zfile.infolist()]
+    nested = {}
+    for info in nested_zip_infos(zfile, max_depth):
+        with OpenNestedZip(zfile, info, member_memory_cap) as inner:
+            if inner is not None:
+                nested[info.filename] = zipfile_members(inner, max_depth - 1, member_memory_cap)
+
+    return {"members": members, "nested": nested}
+
+
+def nested_members(entry, container):
+    """
+    Flatten the members of a zip and the zips inside it
+
+    Parameters
+    ----------
+    entry
+        Dict as returned by zip_members
+    container
+        Path of the zip
+
+    Returns
+    -------
+    nested_members
+        Generator of (container, members), with inner zip containers given as the outer container followed by
+        the member path
+    """
+    yield container, entry["members"]
+    for name, inner in entry.get("nested", {}).items():
+        yield from nested_members(inner, f"{container}/{name}")
+
+
+def nested_zip_infos(zfile: zipfile.ZipFile, max_depth):
+    """
+    Members of a zip file that are zip files themselves
+
+    Parameters
+    ----------
+    zfile
+    max_depth
+        Levels of inner zips still to read. None are returned when it is 0 or less
+
+    Returns
+    -------
+    infos
+        List of ZipInfo of the inner zips
+    """
+    if max_depth <= 0:
+        return []
+    return [info for info in zfile.infolist() if not info.is_dir() and posixpath.splitext(info.filename)[1] == ".zip"]
+
+
+class ZipMemberView(io.RawIOBase):
+    """
+    Read only, seekable view of a stored (uncompressed) zip member, read in place from the containing file
+    """
+
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
         else:
-            zpath = Path(info.filename).parent
-            zfile = Path(info.filename).name
-            if zpath in dlistdb:
-                dlistdb[zpath][1].append(zfile)
+            raise ValueError(f"Invalid whence: {whence}")
+        self.position = max(self.position, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        length = max(min(len(buffer), self.size - self.position), 0)
+        self.fileobj.seek(self.offset + self.position)
+        data = self.fileobj.read(length)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class OpenNestedZip:
+    """
+    Context manager opening a zip file stored inside another zip file, without extracting it to disk. Stored inner
+    zips are read in place through a ZipMemberView. Compressed inner zips are decompressed into memory if they are
+    no larger than member_memory_cap, otherwise None is returned and the inner zip is indexed as a plain file.
+    """
+
+    def __init__(self, zfile: zipfile.ZipFile, info: zipfile.ZipInfo, member_memory_cap):
+        self.zfile = zfile
+        self.info = info
+        self.member_memory_cap = member_memory_cap
+        self.inner = None
+
+    def __enter__(self):
+        try:
+            if self.info.compress_type == zipfile.ZIP_STORED:
+                # Skip the local file header to find where the member data starts
+                self.zfile.fp.seek(self.info.header_offset)
+                header = self.zfile.fp.read(zipfile.sizeFileHeader)
+                if header[:4] != zipfile.stringFileHeader:
+                    raise zipfile.BadZipFile(f"Bad local file header for {self.info.filename}")
+                name_length, extra_length = struct.unpack("<HH", header[26:30])
+                offset = self.info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+                fileobj = ZipMemberView(self.zfile.fp, offset, self.info.file_size)
+            elif self.info.file_size <= self.member_memory_cap:
+                fileobj = io.BytesIO(self.zfile.read(self.info))
             else:
-                dlistdb[zpath] = [[], [zfile]]
+                print(f"Not indexing inner zip {self.info.filename}: {self.info.file_size} bytes is larger than the "
+                      f"memory cap")
+                return None
+            self.inner = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile as e:
+            print(f"Not indexing inner zip {self.info.filename}: {e}")
+            return None
+
+        return self.inner
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.inner is not None:
+            self.inner.close()
+
+
+def members_walk(members):
+    """
+    Convert zip member details to os.walk() output format, as zipwalk does for a zip file
+
+    Parameters
+    ----------
+    members
+        List of [filename, ...] as in the "members" returned by zip_members
+
+    Returns
+    -------
+    dlist
+        List of [dirpath, dirnames, files]
+    """
+    return list(names_walk([member[0] for member in members]))
+
+
+def load_index(index_path, columns=None, filters=None):
+    """
+    Load a columnar (parquet) index written by run_cli with --format parquet
+
+    Parameters
+    ----------
+    index_path
+    columns
+        Columns to load, or None for all. Only these columns are read from disk
+    filters
+        pyarrow style predicates, e.g. [("container", "!=", ""), ("name", "==", "b.txt")]. Row groups that cannot
+        match are skipped without being read
+
+    Returns
+    -------
+    index
+        DataFrame with one row per file
+    """
+    import pandas as pd
+    return pd.read_parquet(index_path, columns=columns, filters=filters)
+
+
+# Mimic os.walk() function for zipfiles
+def zipwalk(file: Path, max_depth=0, member_memory_cap=default_member_memory_cap):
+    """
+    Walk the members of a zip file, yielding (dirpath, dirnames, files) like os.walk(). The zip file is closed
+    when the walk finishes or the generator is closed.
+
+    Parameters
+    ----------
+    file
+    max_depth
+        How many levels of zip files inside the zip file to walk. Each inner zip is walked after the zip containing
+        it, with dirpath relative to the inner zip root
+    member_memory_cap
+
+    Returns
+    -------
+    walk
+        Generator of [dirpath, dirnames, files], with dirpath as a posix string relative to the zip root
+    """
+    with zipfile.ZipFile(str(file)) as zfile:
+        yield from zipfile_walk(zfile, max_depth, member_memory_cap)
+
+
+def zipfile_walk(zfile: zipfile.ZipFile, max_depth, member_memory_cap):
+    """
+    Walk the members of an open zip file and the zips inside it, as zipwalk does for a path
+
+    Parameters
+    ----------
+    zfile
+    max_depth
+        How many levels of zip files inside the zip file to walk
+    member_memory_cap
+
+    Returns
+    -------
+    walk
+        Generator of [dirpath, dirnames, files]
+    """
+    yield from names_walk(zfile.namelist())
+    for info in nested_zip_infos(zfile, max_depth):
+        with OpenNestedZip(zfile, info, member_memory_cap) as inner:
+            if inner is not None:
+                yield from zipfile_walk(inner, max_depth - 1, member_memory_cap)
+
+
+def names_walk(names):
+    """
+    Group zip member names into (dirpath, dirnames, files) rows, yielding each directory as soon as it is complete.
+
+    Zip files are almost always written depth first, so a directory is complete once a member outside it is seen.
+    In that case only the directories on the current path are held in memory, however many members the zip has.
+    Zips in any other order are grouped in a dict instead.
+
+    Parameters
+    ----------
+    names
+        Sequence of member names. Directory members end with a slash
+
+    Returns
+    -------
+    walk
+        Generator of [dirpath, dirnames, files]
+    """
+    if not is_depth_first(names):
+        dlistdb = {}
+        for name in names:
+            zpath, base, is_dir = split_member(name)
+            if zpath not in dlistdb:
+                dlistdb[zpath] = [zpath, [], []]
+            dlistdb[zpath][1 if is_dir else 2].append(base)
+        yield from dlistdb.values()
+        return
+
+    # Stack of open directories, each one within the one below it
+    stack = []
+    for name in names:
+        zpath, base, is_dir = split_member(name)
+        while stack and not is_within(zpath, stack[-1][0]):
+            yield stack.pop()
+        if not stack or stack[-1][0] != zpath:
+            stack.append([zpath, [], []])
+        stack[-1][1 if is_dir else 2].append(base)
+
+    while stack:
+        yield stack.pop()
+
+
+def is_depth_first(names):
+    """
+    Check that no directory of a zip is reopened after a member outside it has been seen, so names_walk can
+    stream it
+
+    Parameters
+    ----------
+    names
+
+    Returns
+    -------
+    depth_first
+    """
+    stack = []
+    closed = set()
+    for name in names:
+        zpath, _, _ = split_member(name)
+        while stack and not is_within(zpath, stack[-1]):
+            closed.add(stack.pop())
+        if not stack or stack[-1] != zpath:
+            if zpath in closed:
+                return False
+            stack.append(zpath)
+
+    return True
+
+
+def split_member(name):
+    """
+    Split a zip member name into its directory and base name
+
+    Parameters
+    ----------
+    name
+
+    Returns
+    -------
+    zpath, base, is_dir
+        zpath is "." for members at the zip root
+    """
+    is_dir = name.endswith("/")
+    zpath, base = posixpath.split(name[:-1] if is_dir else name)
+    return zpath or ".", base, is_dir
+
 
-    # Convert to os.walk() output format
-    dlist = []
-    for key in dlistdb.keys():
-        dlist.append((key, dlistdb[key][0], dlistdb[key][1]))
+def is_within(zpath, directory):
+    """
+    Check whether zpath is directory or one of its subdirectories, for posix strings as returned by split_member
+    """
+    return directory == "." or zpath == directory or zpath.startswith(directory + "/")
 
-    return iter(dlist)
 
 if __name__ == "__main__":
     run_cli()
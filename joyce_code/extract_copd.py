@@ -1,79 +1,102 @@
+import argparse
 import os
-import shutil
+import posixpath
+import sys
 import zipfile
+from multiprocessing import pool
+from pathlib import Path
 
-# specify the directory to search for folders
-# dir_path = '/eresearch/lung/jjoh182/COPDgene/COPDgene_data_from_harddisk/COPDGene'
-dir_path = '/eresearch/copdgene/jjoh182/COPDGene/'
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import extract_zip_directory
 
-# specify the name of the file(s) to search for
-file_name = 'example.txt'
+"""
+Extract the inspiratory lobe segmentations of the COPDGene dataset. The dataset index (from index_zip_folder with
+--format parquet or sqlite) is queried for the segmentations, so only the zip files known to contain them are opened,
+and their members are streamed to disk in bounded buffers by a pool of workers
+"""
 
-# specify the destination directory to copy the folders
-dest_path = '/path/to/your/destination/directory'
+# specify the directory the index was built from
+# dir_path = '/eresearch/lung/jjoh182/COPDgene/COPDgene_data_from_harddisk/COPDGene'
+dir_path = '/eresearch/copdgene/jjoh182/COPDGene/'
 
-def search_zip_folder(zip_file_path):
+# specify the path to the output directory
+# output_dir = "/eresearch/lung/jjoh182/COPDgene/COPDgene_data_from_harddisk/Extracted_folders"
+output_dir = "/eresearch/copdgene/jjoh182/COPDGene_extracted"
+
+
+def run_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", help="Parquet or SQLite dataset index of zip_root, from index_zip_folder",
+                        type=str, required=True)
+    parser.add_argument("--zip_root", help="Directory the index was built from", type=str, default=dir_path)
+    parser.add_argument("--output_root", help="Directory in which to place extracted files", type=str,
+                        default=output_dir)
+    parser.add_argument("--suffix", help="Suffix of the files to extract", type=str, default="Lobes.mhd")
+    parser.add_argument("--inex", help="INSP or EXP, or any", type=str, default="INSP")
+    parser.add_argument("--phase", help="Phase to extract, e.g. COPD1, or any", type=str, default="any")
+    parser.add_argument("--series", help="Extract the whole series directory holding each file, rather than only the "
+                                         "file and its .raw/.zraw data", default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument("--resume", help="Skip members already extracted by a previous run", default=False,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument("--workers", help="Number of worker processes. Defaults to the number of cpus", type=int)
+    args = parser.parse_args()
+
+    criteria = {"suffix": args.suffix, "inex": args.inex, "phase": args.phase}
+    criteria = {key: value for key, value in criteria.items() if value != "any"}
+    index_members = extract_zip_directory.query_index_members(args.index, criteria)
+    print(f"Found {sum(len(members) for members in index_members.values())} files in {len(index_members)} zip files")
+
+    zip_root = Path(args.zip_root)
+    mpool = pool.Pool(args.workers if args.workers is not None else os.cpu_count())
+    if args.series:
+        index_members = find_series_members(zip_root, index_members, mpool)
+    extract_zip_directory.extract_zip_directory(zip_root, Path(args.output_root), mpool, index_members=index_members,
+                                                resume=args.resume)
+
+
+def find_series_members(zip_root: Path, index_members, mpool: pool.Pool):
     """
-    Searches for a file with the specified name in the specified folder within a zip archive.
+    Extend index members to every member of the directories they are in, reading the central directory of only the
+    zip files holding them
+
+    Parameters
+    ----------
+    zip_root
+    index_members
+        Dict of sets of member paths keyed by zip path relative to zip_root, from query_index_members
+    mpool
+
+    Returns
+    -------
+    index_members
+        As index_members, with the rest of each directory added
+    """
+    tasks = [(zip_root / zip_key, zip_key, members) for zip_key, members in index_members.items()]
+    return dict(tqdm(mpool.imap_unordered(series_members, tasks, chunksize=16), desc="Reading zip files",
+                     total=len(tasks)))
 
-    Args:
-    - zip_file_path (str): the path to the zip archive
-    - folder_name (str): the name of the folder to search within
-    - file_name (str): the name of the file to search for
 
-    Returns:
-    - str or None: the path to the found file within the zip archive, or None if the file was not found
+@extract_zip_directory.args_unpacker
+def series_members(zip_file_path, zip_key, members):
     """
-    # specify the path to the output directory
-    # output_dir = "/eresearch/lung/jjoh182/COPDgene/COPDgene_data_from_harddisk/Extracted_folders"
-    output_dir = "/eresearch/copdgene/jjoh182/COPDGene_extracted"
-
-    # create the output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    Worker function listing the members of a zip file in the same directories as members
 
+    Returns
+    -------
+    zip_key, members
+        Zip files that cannot be read keep their members, so the extraction reports them as failed
+    """
+    directories = tuple({posixpath.dirname(member) + "/" for member in members if posixpath.dirname(member)})
     try:
-        # open the zip file for reading
         with zipfile.ZipFile(zip_file_path, 'r') as zip_file:
-            # get a list of all the files in the zip archive
-            zip_files = zip_file.namelist()
-
-            # filter the list to include only the files in the specified folder
-            folder_files = [f for f in zip_files if f.endswith("Lobes.mhd")]
-
-            path_within_zip = [os.path.dirname(f) for f in folder_files if "INSP" in f]
-
-            # construct the output path by removing the path within the zip file from the file path
-            # output_path = os.path.join(output_dir, folder_files[len(path_within_zip):])
-
-            if len(path_within_zip) == 0:
-                print("Folder is empty")
-
-            else:
-
-                for file_path in zip_files:
-
-                    if path_within_zip[0] in file_path:
-                        output_path = os.path.join(output_dir,file_path[len(path_within_zip)-1:])
-
-                        if file_path.endswith('/'):
-                            os.makedirs(output_path,exist_ok=True)
-
-                        else:
-                            # if the file path is a file, extract it to the output directory
-                            with zip_file.open(file_path) as zip_file_contents, open(output_path, 'wb') as output_file:
-                                output_file.write(zip_file_contents.read())
-    except zipfile.BadZipfile:
-        print("bad zip file")
-    print("Extracted",zip_file_path)
-
-    return
-
-# def extract_zip_subfolder(zip_file_path):
+            names = zip_file.namelist()
+    except (OSError, zipfile.BadZipFile):
+        return zip_key, members
+    return zip_key, set(members) | {name for name in names if name.startswith(directories)}
 
 
-# walk through the directory and search for folders containing the specified file(s)
-for root, dirs, files in os.walk(dir_path):
-    for f in files:
-        print(f)
-        insp_folder = search_zip_folder(root+"/"+f)
+if __name__ == "__main__":
+    run_cli()
@@ -4,16 +4,36 @@
 #The conditioning is edited to include equalto, greater than or equal and lesser than or equal
 
 import tkinter as tk
-from tkinter import filedialog, messagebox
-import pandas as pd
+from tkinter import filedialog, messagebox, ttk
 import os
+import queue
 import subprocess
+import sys
+import threading
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+poll_interval_ms = 100
+preview_rows = 5
+default_write_columns = ['sid','finalGold','cohort','gender','age_baseline']
+
+
+class Cancelled(Exception):
+    pass
+
 
 class DataSelector:
     def __init__(self, master):
         self.master = master
         master.title("Data Selector")
 
+        # Loading, selecting and writing run on a worker thread, one task at a time. Its results and progress are
+        # passed back as callbacks through a queue that the Tk thread polls, as Tk must only be used from its thread
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.messages = queue.Queue()
+
         # Create a label and an entry box for the file selection
         self.file_label = tk.Label(master, text="Select a data file:")
         self.file_label.grid(row=0, column=0, padx=5, pady=5)
@@ -44,7 +64,7 @@ class DataSelector:
             label.grid(row=i + 3, column=2, padx=5, pady=5)
             op_var = tk.StringVar(master)
             op_var.set("equal to")
-            op_menu = tk.OptionMenu(master, op_var, "equal to", "greater than", "less than")
+            op_menu = tk.OptionMenu(master, op_var, *condition_operators)
             op_menu.grid(row=i + 3, column=3, padx=5, pady=5)
             self.cond_ops.append(op_var)
 
@@ -54,17 +74,41 @@ class DataSelector:
             entry.grid(row=i + 3, column=5, padx=5, pady=5)
             self.cond_entries.append(entry)
 
+        # Create an entry box for a query expression combined with the conditions above, with any number of
+        # and/or conditions, e.g. gender == 2 and (age_baseline between 60 and 70 or finalGold in (3, 4))
+        self.query_label = tk.Label(master, text="Query expression:")
+        self.query_label.grid(row=self.n_conds + 3, column=0, padx=5, pady=5)
+        self.query_entry = tk.Entry(master, width=80)
+        self.query_entry.grid(row=self.n_conds + 3, column=1, columnspan=5, padx=5, pady=5, sticky="we")
+
         # Create a button to apply the conditions and display the selected data
         self.select_button = tk.Button(master, text="Select Data", command=self.select_data)
-        self.select_button.grid(row=self.n_conds+3, column=1, padx=5, pady=5)
+        self.select_button.grid(row=self.n_conds+4, column=1, padx=5, pady=5)
 
         # Create a text widget to display the selected data
         self.data_text = tk.Text(master)
-        self.data_text.grid(row=self.n_conds+4, column=0, columnspan=4, padx=5, pady=5)
+        self.data_text.grid(row=self.n_conds+5, column=0, columnspan=4, padx=5, pady=5)
 
         # Create a button to write the selected data to CSV
         self.write_button = tk.Button(master, text="Write CSV", command=self.write_csv)
-        self.write_button.grid(row=self.n_conds + 3, column=2, padx=5, pady=5)
+        self.write_button.grid(row=self.n_conds + 4, column=2, padx=5, pady=5)
+
+        # Create a button to cancel the running task, a progress bar and a status line
+        self.cancel_button = tk.Button(master, text="Cancel", command=self.cancel_task, state=tk.DISABLED)
+        self.cancel_button.grid(row=self.n_conds + 4, column=3, padx=5, pady=5)
+        self.progress_bar = ttk.Progressbar(master, length=300, maximum=1.0)
+        self.progress_bar.grid(row=self.n_conds + 6, column=0, columnspan=2, padx=5, pady=5, sticky="we")
+        self.status_label = tk.Label(master, text="", anchor="w")
+        self.status_label.grid(row=self.n_conds + 6, column=2, columnspan=4, padx=5, pady=5, sticky="we")
+
+        # Create an entry box for the columns to write, all columns when empty
+        self.columns_label = tk.Label(master, text="Columns to write:")
+        self.columns_label.grid(row=self.n_conds + 7, column=0, padx=5, pady=5)
+        self.columns_entry = tk.Entry(master, width=80)
+        self.columns_entry.insert(0, ", ".join(default_write_columns))
+        self.columns_entry.grid(row=self.n_conds + 7, column=1, columnspan=5, padx=5, pady=5, sticky="we")
+
+        self.poll_messages()
 
     def browse_file(self):
         filename = filedialog.askopenfilename(initialdir="/", title="Select a data file", filetypes=[("CSV files", "*.txt")])
@@ -72,8 +116,21 @@ class DataSelector:
         self.file_entry.insert(0, filename)
 
     def load_file(self):
+        import copdgene_data
+        import subject_query
         filename = self.file_entry.get()
-        self.df = pd.read_csv(filename,sep='\t')
+
+        def load(progress):
+            df = copdgene_data.read_subject_data(filename, cache_directory=copdgene_data.default_cache_directory,
+                                                 progress=progress)
+            # Sorted column indexes and condition results are kept for this frame, so repeated selections are fast
+            return df, subject_query.QueryEngine(df)
+
+        self.run_task(f"Loading {Path(filename).name}", load, self.file_loaded)
+
+    def file_loaded(self, result):
+        self.df, self.query_engine = result
+        self.set_status(f"Loaded {len(self.df)} subjects with {len(self.df.columns)} columns")
 
     # def select_data(self):
     #     conditions = []
@@ -115,69 +172,150 @@ class DataSelector:
         #         self.selected_data = self.selected_data[self.selected_data[column_name] == condition_value]
         # self.show_data(self.selected_data)
 
-        # Create a list to hold the conditions
-        conditions = []
-
-        # Get the column names and condition values from the entry boxes
+        # Build a query expression from the conditions and the query entry box
+        clauses = []
         for i in range(self.n_conds):
-            col_name = self.cond_entries[i * 2].get()
-            cond_value = self.cond_entries[i * 2 + 1].get()
+            col_name = self.cond_entries[i * 2].get().strip()
+            cond_value = self.cond_entries[i * 2 + 1].get().strip()
             cond_type = self.cond_ops[i].get()
             if col_name and cond_value and cond_type:
-                # Check if condition_value is a number, and convert to int if it is
-                try:
-                    cond_value = int(cond_value)
-                except ValueError:
-                    pass
-
-                # Add the condition to the list
-                conditions.append((col_name, cond_value, cond_type))
-
-        # Apply the conditions to the data
-        if conditions:
-            # Initialize a boolean Series with True values
-            mask = pd.Series([True] * len(self.df))
-
-            # Iterate over the conditions and update the mask
-            for col_name, cond_value, cond_type in conditions:
-
-                if isinstance(cond_value, int):
-                    if cond_type == "equal to":
-                        mask &= (self.df[col_name] == cond_value)
-                    elif cond_type == "greater than":
-                        mask &= (self.df[col_name] > float(cond_value))
-                    elif cond_type == "less than":
-                        mask &= (self.df[col_name] < float(cond_value))
-                    elif cond_type == "not_equal":
-                        mask &= (self.df[col_name] != cond_value)
-                    else:
-                        messagebox.showerror("Error", f"Invalid condition type '{cond_type}'.")
-                        return
-                else:
-                    mask &= (self.df[col_name] == cond_value)
-
-            # Filter the data using the mask
-            self.selected_data = self.df[mask]
-
-        self.show_data(self.selected_data)
+                clauses.append(f"{col_name} {condition_operators[cond_type]} {query_value(cond_value)}")
+        if expression := self.query_entry.get().strip():
+            clauses.append(f"({expression})")
+
+        expression = " and ".join(clauses)
+
+        if not hasattr(self, "query_engine"):
+            messagebox.showerror("Error", "Load a data file first.")
+            return
+        df, query_engine = self.df, self.query_engine
+
+        def select(progress):
+            # Every row is selected without conditions
+            import numpy as np
+            positions = np.flatnonzero(query_engine.mask(expression)) if expression else np.arange(len(df))
+            # Preview the first matches before taking every matching row
+            self.post(self.show_data, df.iloc[positions[:preview_rows]])
+            self.post(self.set_status, f"Selecting {len(positions)} subjects")
+            progress(0.5, 1)
+            return df.iloc[positions]
+
+        self.run_task("Selecting", select, self.data_selected)
+
+    def data_selected(self, selected_data):
+        self.selected_data = selected_data
+        self.set_status(f"Selected {len(selected_data)} subjects")
 
     def show_data(self, data):
         self.data_text.delete('1.0', tk.END)  # Clear previous data in the text box
         self.data_text.insert(tk.END, data.head())  # Insert the head of the selected data
 
     def write_csv(self):
-        subset = ['sid','finalGold','cohort','gender','age_baseline']
-        data_subset = self.selected_data[subset]
-        data = data_subset.to_csv(index=False)
-        if not data:
+        import copdgene_data
+        columns = self.columns_entry.get().replace(",", " ").split() or None
+        data = self.selected_data
+        if missing := [column for column in columns or [] if column not in data.columns]:
+            messagebox.showerror("Error", f"Unknown columns: {', '.join(missing)}")
             return
-        filename = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        filename = filedialog.asksaveasfilename(defaultextension=".csv",
+                                                filetypes=[("CSV files", "*.csv"), ("Compressed CSV files", "*.csv.gz"),
+                                                           ("Parquet files", "*.parquet")])
         if filename:
-            with open(filename, "w") as f:
-                f.write(data)
+            def write(progress):
+                # Streams the selection to the file in chunks of rows
+                copdgene_data.write_subject_data(data, filename, columns=columns, progress=progress)
+                return filename
+
+            self.run_task(f"Writing {Path(filename).name}", write, self.csv_written)
+
+    def csv_written(self, filename):
+        self.set_status(f"Wrote {filename}")
+        if filename.lower().endswith(".csv"):
             subprocess.run(["xdg-open",filename])
 
+    def run_task(self, description, task, on_done):
+        """
+        Run task(progress) on the worker thread, unless a task is running. progress(done, total) updates the progress
+        bar and raises Cancelled once the task is cancelled, so tasks call it between steps. on_done(result) is
+        called on the Tk thread when the task finishes, and errors are shown in a message box
+        """
+        if self.worker is not None and self.worker.is_alive():
+            messagebox.showinfo("Busy", "Wait for the running task to finish, or cancel it.")
+            return
+        self.cancel_event.clear()
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar.config(value=0)
+        self.set_status(f"{description}...")
+        reported = [None]
+
+        def progress(done, total):
+            if self.cancel_event.is_set():
+                raise Cancelled()
+            # Only pass on whole percent changes, progress can be called for every block of a file
+            if (percent := int(100 * done / total) if total else 0) != reported[0]:
+                reported[0] = percent
+                self.post(self.progress_bar.config, {"value": percent / 100})
+
+        def work():
+            try:
+                result = task(progress)
+            except Cancelled:
+                self.post(self.task_finished, f"{description} cancelled")
+            except Exception as e:
+                self.post(self.task_finished, f"{description} failed")
+                self.post(messagebox.showerror, "Error", f"{description} failed: {e}")
+            else:
+                self.post(self.task_finished, None)
+                self.post(on_done, result)
+
+        self.worker = threading.Thread(target=work, daemon=True)
+        self.worker.start()
+
+    def cancel_task(self):
+        self.cancel_event.set()
+        self.set_status("Cancelling...")
+
+    def task_finished(self, status):
+        self.cancel_button.config(state=tk.DISABLED)
+        self.progress_bar.config(value=0)
+        if status is not None:
+            self.set_status(status)
+
+    def set_status(self, text):
+        self.status_label.config(text=text)
+
+    def post(self, callback, *args):
+        """
+        Call callback(*args) on the Tk thread, from any thread
+        """
+        self.messages.put((callback, args))
+
+    def poll_messages(self):
+        while True:
+            try:
+                callback, args = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+        self.master.after(poll_interval_ms, self.poll_messages)
+
+
+condition_operators = {"equal to": "==", "not equal to": "!=", "greater than": ">", "greater or equal": ">=",
+                       "less than": "<", "less or equal": "<="}
+
+
+def query_value(value):
+    """
+    Condition value as it is written in a query expression: numbers as they are, anything else quoted
+    """
+    try:
+        float(value)
+        return value
+    except ValueError:
+        return f'"{value}"' if '"' not in value else f"'{value}'"
+
 
-root = tk.Tk()
-selector = DataSelector(root)
-root.mainloop()
+if __name__ == "__main__":
+    root = tk.Tk()
+    selector = DataSelector(root)
+    root.mainloop()
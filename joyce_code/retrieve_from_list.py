@@ -1,81 +1,121 @@
-import os
-import glob
+import argparse
+import json
+import sys
+from pathlib import Path
 import pandas as pd
 
-file = "/eresearch/lung/jjoh182/COPDgene/COPDGene_Phase1_SM_NS_25OCT21.txt"
-
-subjects1 = "QtD_6015.csv"
-pvv_subs = '/eresearch/copdgene/jjoh182/COPD_QtD_results/Output_csvs/vessel_like.csv'
-# subjects2 = "/eresearch/copdgene/jjoh182/COPD_QtD_results/Output_csvs/allQtDs.csv"
-# prism = "/home/jjoh182/PythonProjectMaster/PRISm_BPV/wholeLung_merged.csv"
-qtd520 = "/home/jjoh182/PythonProjectMaster/QtD_COPD_outputs/QtD_520.csv"
-
-sub_list1 = pd.read_csv(subjects1)
-# sub_list2 = pd.read_csv(subjects2)
-
-# sub_list = pd.concat([sub_list1,sub_list2],ignore_index=True)
-# sub_list = sub_list.drop_duplicates()
-
-sub_list = sub_list1
-# sub_list = pd.read_csv(prism)
-sub_list = pd.read_csv(qtd520)
-
-data = pd.read_csv(file,sep="\t")
-
-# sub_list = sub_list.rename(columns={'CID':'sid'})
-sub_list = sub_list.rename(columns={'file':'sid'})
-# retrieve_list = ['sid','cohort','gender','race','ethnic','smoking_status','age_visit','BMI','finalGold',
-#                  'Height_CM','Weight_KG','HR','TLC_CT','FRC_CT','pctEmph_Thirona',
-#                  'DLco_GLI_tr_pp','VA_pp','Kco_tr_pp','FEV1pp_post','FVCpp_post','TLC_pp_plethy',
-#                  'FEV1_FVC_post','MeanAtten_Insp_total_Thirona','Insp_totalvolume_total_Thirona']
-
-retrieve_list = ['sid','cohort','gender','race','ethnic','smoking_status','age_visit','BMI','finalGold',
-                 'Height_CM','Weight_KG','HR','TLC_CT','FRC_CT','pctEmph_Thirona',
-                 'DLco_GLI_tr_pp','VA_pp','Kco_tr_pp','FEV1pp_post','FVCpp_post','TLC_pp_plethy',
-                 'FEV1_FVC_post','MeanAtten_Insp_total_Thirona','Insp_totalvolume_total_Thirona',
-                 'MMRCDyspneaScor','SGRQ_scoreSymptom','SGRQ_scoreActive','SGRQ_scoreImpact','SGRQ_scoreTotal',
-                 'SF36_PF_t_score','SF36_RP_t_score','SF36_RE_t_score','SF36_SF_t_score','SF36_BP_t_score',
-                 'SF36_VT_t_score','SF36_MH_t_score','SF36_GH_t_score',#'SF36_PCS_t_score','SF36_MCS_t_score',
-                 'BDR_pct_FEV1','BDR_pct_FVC','Exacerbation_Frequency','NewGOLD_SGRQ',#'AWT_Seg_Thirona','Walk_Total'
-                 'O2_suppl_6MW','distwalked','Walk_Course']
-#TO RETRIEVE LONGITUDINAL DATA
-retrieve_list2 = ['sid',
-                  'Change_P1_P2_Gold_class','Change_P1_P2_FEV1pp','Change_P1_P2_MMRC','Change_P1_P2_SGRQ_total',
-                  'Change_P1_P2_distwalked','Change_P1_P2_O2','Change_TLC_Thirona','Change_pctEmph_Thirona',
-                  'Change_FRC_Thirona','Change_pctGasTrap_Thirona','Change_Perc15_Insp_Thirona',
-                  'Change_Perc15_Exp_Thirona','Change_MeanAtten_Insp_Thirona','Change_MeanAtten_Exp_Thirona',
-                  'Change_Adj_Density_plethy','Change_Adj_Density_mesa','Change_pctEmph_LUL_Thirona',
-                  'Change_pctEmph_LLL_Thirona','Change_pctEmph_RUL_Thirona','Change_pctEmph_RML_Thirona',
-                  'Change_pctEmph_RLL_Thirona','Change_PRM_pct_emphysema_Thirona','Change_PRM_pct_airtrap_Thirona',
-                  'Change_PRM_pct_normal_Thirona','Change_PRM_pct_other_Thirona']
-
-# rows=list(sub_list['sid'])
-# subset = data[data['sid'].isin(rows)]
-# subset_select = subset[retrieve_list]
-# subset_select.to_csv("/eresearch/copdgene/jjoh182/COPD_QtD_results/Output_csvs/Demographics_allQtDs2.csv",index=None)
-
-merged_df = pd.merge(sub_list, data[retrieve_list], on='sid', how='left')
-# merged_df.to_csv("/home/jjoh182/PythonProjectMaster/PRISm_BPV/Demographics_all.csv",index=False)
-merged_df.to_csv("/home/jjoh182/PythonProjectMaster/QtD_COPD_outputs/Demo_outcomes_520.csv",index=False)
-
-print(merged_df)
-
-###########################
-# to retrieve longitudinal
-file2 = "/eresearch/lung/jjoh182/COPDgene/COPDGene_P1P2_SM_NS_25OCT21.txt"
-
-data2 = pd.read_csv(file2,sep="\t",low_memory=False)
-
-#TO RETRIEVE LONGITUDINAL DATA
-retrieve_list2 = ['sid',
-                  'Change_P1_P2_Gold_class','Change_P1_P2_FEV1pp','Change_P1_P2_MMRC','Change_P1_P2_SGRQ_total',
-                  'Change_P1_P2_distwalked','Change_P1_P2_O2','Change_TLC_Thirona','Change_pctEmph_Thirona',
-                  'Change_FRC_Thirona','Change_pctGasTrap_Thirona','Change_Perc15_Insp_Thirona',
-                  'Change_Perc15_Exp_Thirona','Change_MeanAtten_Insp_Thirona','Change_MeanAtten_Exp_Thirona',
-                  'Change_Adj_Density_plethy','Change_Adj_Density_mesa','Change_pctEmph_LUL_Thirona',
-                  'Change_pctEmph_LLL_Thirona','Change_pctEmph_RUL_Thirona','Change_pctEmph_RML_Thirona',
-                  'Change_pctEmph_RLL_Thirona','Change_PRM_pct_emphysema_Thirona','Change_PRM_pct_airtrap_Thirona',
-                  'Change_PRM_pct_normal_Thirona','Change_PRM_pct_other_Thirona']
-
-merged_df2 = pd.merge(sub_list, data2[retrieve_list2], on='sid', how='left')
-merged_df2.to_csv("/home/jjoh182/PythonProjectMaster/QtD_COPD_outputs/Demo_outcomes_520_longitudinal.csv",index=False)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import copdgene_data
+
+"""
+Retrieve COPDGene subject data for lists of subjects. Each named column set comes from one data file, and each data
+file is loaded once, with only the columns and subjects any list needs, to serve every list and column set
+"""
+
+data_files = {"phase1": "/eresearch/lung/jjoh182/COPDgene/COPDGene_Phase1_SM_NS_25OCT21.txt",
+              "p1p2": "/eresearch/lung/jjoh182/COPDgene/COPDGene_P1P2_SM_NS_25OCT21.txt"}
+
+column_sets = {
+    "demographics": ("phase1",
+                     ['sid','cohort','gender','race','ethnic','smoking_status','age_visit','BMI','finalGold',
+                      'Height_CM','Weight_KG','HR','TLC_CT','FRC_CT','pctEmph_Thirona',
+                      'DLco_GLI_tr_pp','VA_pp','Kco_tr_pp','FEV1pp_post','FVCpp_post','TLC_pp_plethy',
+                      'FEV1_FVC_post','MeanAtten_Insp_total_Thirona','Insp_totalvolume_total_Thirona',
+                      'MMRCDyspneaScor','SGRQ_scoreSymptom','SGRQ_scoreActive','SGRQ_scoreImpact','SGRQ_scoreTotal',
+                      'SF36_PF_t_score','SF36_RP_t_score','SF36_RE_t_score','SF36_SF_t_score','SF36_BP_t_score',
+                      'SF36_VT_t_score','SF36_MH_t_score','SF36_GH_t_score',#'SF36_PCS_t_score','SF36_MCS_t_score',
+                      'BDR_pct_FEV1','BDR_pct_FVC','Exacerbation_Frequency','NewGOLD_SGRQ',#'AWT_Seg_Thirona','Walk_Total'
+                      'O2_suppl_6MW','distwalked','Walk_Course']),
+    # Longitudinal data
+    "longitudinal": ("p1p2",
+                     ['sid',
+                      'Change_P1_P2_Gold_class','Change_P1_P2_FEV1pp','Change_P1_P2_MMRC','Change_P1_P2_SGRQ_total',
+                      'Change_P1_P2_distwalked','Change_P1_P2_O2','Change_TLC_Thirona','Change_pctEmph_Thirona',
+                      'Change_FRC_Thirona','Change_pctGasTrap_Thirona','Change_Perc15_Insp_Thirona',
+                      'Change_Perc15_Exp_Thirona','Change_MeanAtten_Insp_Thirona','Change_MeanAtten_Exp_Thirona',
+                      'Change_Adj_Density_plethy','Change_Adj_Density_mesa','Change_pctEmph_LUL_Thirona',
+                      'Change_pctEmph_LLL_Thirona','Change_pctEmph_RUL_Thirona','Change_pctEmph_RML_Thirona',
+                      'Change_pctEmph_RLL_Thirona','Change_PRM_pct_emphysema_Thirona','Change_PRM_pct_airtrap_Thirona',
+                      'Change_PRM_pct_normal_Thirona','Change_PRM_pct_other_Thirona']),
+}
+
+
+def run_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subject_lists", help="CSV files listing subjects, one output per list and column set",
+                        nargs="+", type=str, required=True)
+    parser.add_argument("--list_sid_column", help="Column of the subject lists holding the sid, e.g. file or CID",
+                        type=str, default="sid")
+    parser.add_argument("--column_sets", help=f"Column sets to retrieve, from {', '.join(column_sets)} and "
+                                              f"--column_sets_file", nargs="+", type=str, default=list(column_sets))
+    parser.add_argument("--column_sets_file", help="JSON file of further column sets, as "
+                                                   "{\"name\": {\"data\": \"phase1\", \"columns\": [...]}}", type=str)
+    parser.add_argument("--data_files", help="Data files as name=path, overriding or adding to "
+                                             f"{', '.join(data_files)}", nargs="+", type=str, default=[])
+    parser.add_argument("--output_directory", help="Directory for the <list>_<column set>.csv outputs", type=str,
+                        default="output")
+    parser.add_argument("--cache", help="Cache the parsed data files so later runs load quickly", default=True,
+                        action=argparse.BooleanOptionalAction)
+    parser.add_argument("--cache_directory", help="Directory of the cache", type=str,
+                        default=str(copdgene_data.default_cache_directory))
+    args = parser.parse_args()
+
+    files = data_files | dict(d.split("=", 1) for d in args.data_files)
+    sets = dict(column_sets)
+    if args.column_sets_file is not None:
+        with open(args.column_sets_file) as f:
+            sets.update({name: (column_set["data"], column_set["columns"]) for name, column_set in json.load(f).items()})
+    if unknown := [name for name in args.column_sets if name not in sets]:
+        parser.error(f"Unknown column sets: {', '.join(unknown)}")
+    sets = {name: sets[name] for name in args.column_sets}
+    if unknown := sorted({data for data, _ in sets.values()} - set(files)):
+        parser.error(f"No data file for: {', '.join(unknown)}")
+
+    subject_lists = {Path(file).stem: read_subject_list(file, args.list_sid_column) for file in args.subject_lists}
+
+    output_directory = Path(args.output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    for (list_name, set_name), merged in retrieve(subject_lists, sets, files,
+                                                  args.cache_directory if args.cache else None):
+        merged.to_csv(output_directory / f"{list_name}_{set_name}.csv", index=False)
+        print(f"{list_name}_{set_name}: {len(merged)} subjects")
+
+
+def read_subject_list(file, sid_column="sid"):
+    return pd.read_csv(file).rename(columns={sid_column: copdgene_data.sid_column})
+
+
+def retrieve(subject_lists, sets, files, cache_directory=None):
+    """
+    Retrieve every column set for every subject list. Each data file is loaded once with the union of the columns
+    of its column sets and of the listed subjects, and indexed by sid
+
+    Parameters
+    ----------
+    subject_lists
+        Dict of list name to DataFrame with a sid column
+    sets
+        Dict of column set name to (data file name, columns)
+    files
+        Dict of data file name to path
+    cache_directory
+        As copdgene_data.read_subject_data
+
+    Yields
+    ------
+    (list name, column set name), merged
+        The subject list with the column set's columns joined on, as a left merge
+    """
+    sids = pd.concat([subject_list[copdgene_data.sid_column] for subject_list in subject_lists.values()]).unique()
+    for data_name in dict.fromkeys(data for data, _ in sets.values()):
+        data_sets = {name: columns for name, (data, columns) in sets.items() if data == data_name}
+        columns = list(dict.fromkeys(column for columns in data_sets.values() for column in columns))
+        table = copdgene_data.SubjectTable(files[data_name], columns=columns, sids=sids,
+                                           cache_directory=cache_directory)
+        for set_name, set_columns in data_sets.items():
+            for list_name, subject_list in subject_lists.items():
+                yield (list_name, set_name), table.retrieve(subject_list, set_columns)
+
+
+if __name__ == "__main__":
+    run_cli()
@@ -0,0 +1,242 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import copdgene_data
+
+"""
+Aggregate cube of COPDGene subject statistics: participant counts for every combination of the coded columns and
+binned numeric columns that occurs in a cohort. Distributions and histograms for any slice of the cohort, e.g. the
+gold stage of female subjects aged 60-70, are summed from the cube without the row level data. Cubes are cached next
+to the data cache and updated incrementally, from only the subjects added to or removed from a cohort
+"""
+
+
+class AggregateCube:
+    """
+    Participant counts indexed by one level per dimension. Binned dimensions hold the start of each bin, and the
+    others hold labels as strings, with NaN for missing values
+    """
+
+    def __init__(self, counts: pd.Series, bin_widths, sids):
+        """
+        Parameters
+        ----------
+        counts
+            Counts with a MultiIndex of the dimensions
+        bin_widths
+            Dict of binned dimension to bin width
+        sids
+            Set of the subjects of the cohort, including any without rows in the data
+        """
+        self.counts = counts
+        self.bin_widths = bin_widths
+        self.sids = sids
+
+    @property
+    def dimensions(self):
+        return list(self.counts.index.names)
+
+    @classmethod
+    def from_rows(cls, data, dimensions, bin_widths):
+        """
+        Build a cube from subject data rows
+
+        Parameters
+        ----------
+        data
+            Subject data with sid and the dimension columns, coded columns decoded
+        dimensions
+            Columns to count by
+        bin_widths
+            Dict of numeric dimension to bin width. Other dimensions are counted by value
+        """
+        keys = {}
+        for dimension in dimensions:
+            if dimension in bin_widths:
+                width = bin_widths[dimension]
+                keys[dimension] = np.floor(data[dimension].astype("float64") / width) * width
+            else:
+                keys[dimension] = data[dimension].astype("str")
+        counts = pd.DataFrame(keys).groupby(list(dimensions), dropna=False).size()
+        return cls(counts, dict(bin_widths), set(data["sid"]))
+
+    def updated(self, sids, added, removed):
+        """
+        Cube for the cohort with subjects added and removed
+
+        Parameters
+        ----------
+        sids
+            Subjects of the updated cohort
+        added
+            Rows of the subjects to add, which must not already be counted
+        removed
+            Rows of counted subjects to remove
+
+        Returns
+        -------
+        cube
+            New AggregateCube
+        """
+        counts = self.counts
+        for rows, sign in [(added, 1), (removed, -1)]:
+            if len(rows) > 0:
+                delta = AggregateCube.from_rows(rows, self.dimensions, self.bin_widths).counts
+                counts = counts.add(sign * delta, fill_value=0)
+        counts = counts[counts > 0].astype("int64")
+        return AggregateCube(counts, self.bin_widths, set(sids))
+
+    def select(self, **filters):
+        """
+        Counts of the cells matching every filter
+
+        Parameters
+        ----------
+        filters
+            Dimension to a value, a list of values, or for binned dimensions a (low, high) range that selects the
+            bins lying within it, e.g. gender="Female", age_baseline=(60, 70)
+
+        Returns
+        -------
+        counts
+            Counts of the matching cells, indexed as the cube
+        """
+        match = np.ones(len(self.counts), dtype=bool)
+        for dimension, value in filters.items():
+            level = self.counts.index.get_level_values(dimension)
+            if dimension in self.bin_widths and isinstance(value, tuple):
+                low, high = value
+                match &= ((level >= low) if low is not None else True) & (
+                    (level + self.bin_widths[dimension] <= high) if high is not None else True)
+            elif isinstance(value, list):
+                match &= level.isin([str(v) for v in value] if dimension not in self.bin_widths else value)
+            else:
+                match &= level == (str(value) if dimension not in self.bin_widths else value)
+        return self.counts[match]
+
+    def query(self, by, **filters):
+        """
+        Distribution of one dimension over the cells matching the filters, e.g.
+        query("finalgold_baseline", gender="Female", age_baseline=(60, 70))
+
+        Returns
+        -------
+        counts
+            Series of counts indexed by the values of by, most common first
+        """
+        counts = self.select(**filters).groupby(level=by, dropna=False).sum()
+        return counts[counts > 0].sort_values(ascending=False, kind="stable")
+
+    def histogram(self, dimension, **filters):
+        """
+        Histogram of a binned dimension over the cells matching the filters
+
+        Returns
+        -------
+        counts, edges
+            As numpy.histogram, with empty bins between the first and last filled
+        """
+        counts = self.select(**filters).groupby(level=dimension).sum()
+        counts = counts[counts > 0]
+        width = self.bin_widths[dimension]
+        if len(counts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(1)
+        bins = np.arange(np.round(counts.index.min() / width), np.round(counts.index.max() / width) + 2)
+        counts = counts.reindex(bins[:-1] * width, fill_value=0)
+        return counts.to_numpy(), bins * width
+
+    def save(self, path, key):
+        """
+        Write the cube to parquet, recording key, the bin widths and the subjects counted in the schema metadata
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(self.counts.rename("count").reset_index(), preserve_index=False)
+        metadata = {"key": key, "bin_widths": self.bin_widths, "sids": sorted(self.sids)}
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"cube": json.dumps(metadata)})
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(path).with_name(Path(path).name + ".tmp")
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a cube written by save
+
+        Returns
+        -------
+        cube, key
+            The cube and the key it was saved with
+        """
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        metadata = json.loads(table.schema.metadata[b"cube"])
+        frame = table.to_pandas()
+        dimensions = [column for column in frame.columns if column != "count"]
+        bin_widths = metadata["bin_widths"]
+        frame = frame.astype({dimension: "str" for dimension in dimensions if dimension not in bin_widths})
+        counts = frame.set_index(dimensions)["count"]
+        return cls(counts, bin_widths, set(metadata["sids"])), metadata["key"]
+
+
+def cached_cube(data_file, data_dict_file, cohort, sids, read_rows, cache_directory, dimensions, bin_widths):
+    """
+    Load the cube of a cohort from the cache, updating it from the rows of the subjects added to or removed from
+    the cohort since it was cached. It is rebuilt from every row when the data file, data dictionary, dimensions or
+    bin widths change
+
+    Parameters
+    ----------
+    data_file
+        Subject data file the cube counts
+    data_dict_file
+        Data dictionary the rows' labels are decoded with
+    cohort
+        Name of the cohort, e.g. the subject list's name, or "" for every subject
+    sids
+        Subjects of the cohort, or None for every subject
+    read_rows
+        Function returning the decoded rows of a list of sids, or of every subject for None
+    cache_directory
+    dimensions
+    bin_widths
+
+    Returns
+    -------
+    cube
+    """
+    path = copdgene_data.cache_file(data_file, cache_directory, f"-cube-{cohort or 'all'}.parquet")
+    key = {"data": copdgene_data.source_key(data_file), "data_dict": copdgene_data.source_key(data_dict_file),
+           "dimensions": list(dimensions), "bin_widths": bin_widths}
+
+    cube = None
+    if path.exists():
+        try:
+            cube, cached_key = AggregateCube.load(path)
+        except (OSError, KeyError, ValueError):
+            cube, cached_key = None, None
+        if cached_key != key:
+            cube = None
+
+    if cube is None:
+        cube = AggregateCube.from_rows(read_rows(list(sids) if sids is not None else None), dimensions, bin_widths)
+        if sids is not None:
+            cube.sids = set(sids)
+    elif sids is not None:
+        sids = set(sids)
+        added = sorted(sids - cube.sids)
+        removed = sorted(cube.sids - sids)
+        if not added and not removed:
+            return cube
+        delta = read_rows(added + removed)
+        cube = cube.updated(sids, delta[delta["sid"].isin(added)], delta[delta["sid"].isin(removed)])
+    else:
+        return cube
+
+    cube.save(path, key)
+    return cube
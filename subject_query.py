@@ -0,0 +1,337 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+"""
+Query engine for subject data frames. Expressions such as
+
+    gender == 2 and (age_baseline between 60 and 70 or finalGold in (3, 4)) and not FEV1pp_post is na
+
+are parsed once into a tree and evaluated as vectorised NumPy predicates. Numeric comparisons use a sorted index of
+the column, built on first use and kept, so repeated range queries on large columns are binary searches. Missing
+values never match a comparison, negated or not, so "not x == 1" and "x not in (1)" select the same rows as
+"x != 1"; use "is na" / "is not na" to select them.
+"""
+
+comparison_operators = ["==", "!=", "<", "<=", ">", ">="]
+token_pattern = re.compile(r"""\s*(?:(?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?![A-Za-z_])
+                                 |(?P<string>'[^']*'|"[^"]*")
+                                 |(?P<operator><=|>=|==|!=|=|<|>|\(|\)|,)
+                                 |(?P<word>[A-Za-z_][A-Za-z0-9_.]*))""", re.VERBOSE)
+keywords = {"and", "or", "not", "in", "between", "is", "na"}
+max_cached_masks = 64
+
+
+class QueryError(ValueError):
+    pass
+
+
+def parse(expression):
+    """
+    Parse a query expression into a tree of tuples: ("and", [nodes]), ("or", [nodes]), ("not", node),
+    ("compare", column, operator, value), ("in", column, values), ("between", column, low, high) and ("na", column)
+
+    Grammar (keywords are case insensitive, = is the same as ==)::
+
+        expression := term ("or" term)*
+        term := factor ("and" factor)*
+        factor := "not" factor | "(" expression ")" | condition
+        condition := column operator value | column ["not"] "in" "(" value ("," value)* ")"
+                     | column ["not"] "between" value "and" value | column "is" ["not"] "na"
+    """
+    tokens = tokenize(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def take(kind=None, text=None):
+        nonlocal position
+        token_kind, token_text = peek()
+        if token_kind is None or (kind is not None and token_kind != kind) or (text is not None and token_text != text):
+            expected = text or kind or "more input"
+            raise QueryError(f"Expected {expected} at {token_text if token_text is not None else 'end of query'!r}")
+        position += 1
+        return token_text
+
+    def is_keyword(text):
+        return peek() == ("keyword", text)
+
+    def expression_node():
+        nodes = [term_node()]
+        while is_keyword("or"):
+            take()
+            nodes.append(term_node())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def term_node():
+        nodes = [factor_node()]
+        while is_keyword("and"):
+            take()
+            nodes.append(factor_node())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def factor_node():
+        if is_keyword("not"):
+            take()
+            return "not", factor_node()
+        if peek() == ("operator", "("):
+            take()
+            node = expression_node()
+            take("operator", ")")
+            return node
+        return condition_node()
+
+    def value():
+        kind, text = peek()
+        if kind not in ["number", "string", "word"]:
+            raise QueryError(f"Expected a value at {text if text is not None else 'end of query'!r}")
+        take()
+        return float(text) if kind == "number" else text.strip("'\"") if kind == "string" else text
+
+    def condition_node():
+        column = take("word")
+        negate = False
+        if is_keyword("not"):
+            take()
+            negate = True
+        kind, text = peek()
+        if kind == "keyword" and text == "in":
+            take()
+            take("operator", "(")
+            values = [value()]
+            while peek() == ("operator", ","):
+                take()
+                values.append(value())
+            take("operator", ")")
+            node = "in", column, values
+        elif kind == "keyword" and text == "between":
+            take()
+            low = value()
+            take("keyword", "and")
+            node = "between", column, low, value()
+        elif kind == "keyword" and text == "is" and not negate:
+            take()
+            if is_keyword("not"):
+                take()
+                negate = True
+            take("keyword", "na")
+            node = "na", column
+        elif kind == "operator" and text in comparison_operators + ["="] and not negate:
+            take()
+            node = "compare", column, "==" if text == "=" else text, value()
+        else:
+            raise QueryError(f"Expected a condition on {column!r} at {text if text is not None else 'end of query'!r}")
+        return ("not", node) if negate else node
+
+    node = expression_node()
+    if position < len(tokens):
+        raise QueryError(f"Unexpected {tokens[position][1]!r}")
+    return node
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = token_pattern.match(expression, position)
+        if match is None or match.end() == position:
+            raise QueryError(f"Cannot parse query at {expression[position:].strip()!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == "word" and text.lower() in keywords:
+            kind, text = "keyword", text.lower()
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class QueryEngine:
+    """
+    Evaluates query expressions against one DataFrame. Sorted indexes of numeric columns and the masks of recent
+    conditions are cached, so the frame must not be modified while the engine is in use
+    """
+
+    def __init__(self, data: pd.DataFrame):
+        self.data = data
+        self.sorted_indexes = {}
+        self.condition_masks = {}
+
+    def select(self, expression):
+        """
+        Rows of the frame matching an expression, or every row for an empty expression
+        """
+        if not expression.strip():
+            return self.data
+        return self.data[self.mask(expression)]
+
+    def mask(self, expression):
+        """
+        Boolean NumPy array of the rows matching an expression
+        """
+        return self.evaluate(parse(expression))
+
+    def evaluate(self, node, negate=False):
+        """
+        Mask of the rows matching a tree from parse, or with negate, of the rows failing it. Negations are pushed down
+        to the conditions, where rows missing the column neither match nor fail
+        """
+        kind = node[0]
+        if kind in ["and", "or"]:
+            # not (a and b) is (not a) or (not b), and not (a or b) is (not a) and (not b)
+            conjunction = (kind == "and") != negate
+            mask = self.evaluate(node[1][0], negate).copy()
+            for child in node[1][1:]:
+                if conjunction:
+                    mask &= self.evaluate(child, negate)
+                else:
+                    mask |= self.evaluate(child, negate)
+            return mask
+        if kind == "not":
+            return self.evaluate(node[1], not negate)
+        if not negate:
+            return self.condition_mask(node)
+        if kind == "na":
+            return ~self.condition_mask(node)
+        return ~self.condition_mask(node) & ~self.condition_mask(("na", node[1]))
+
+    def condition_mask(self, node):
+        key = tuple(tuple(part) if isinstance(part, list) else part for part in node)
+        if (mask := self.condition_masks.pop(key, None)) is None:
+            mask = self.compute_condition_mask(node)
+            mask.flags.writeable = False
+        # Keep the most recently used masks
+        self.condition_masks[key] = mask
+        if len(self.condition_masks) > max_cached_masks:
+            del self.condition_masks[next(iter(self.condition_masks))]
+        return mask
+
+    def compute_condition_mask(self, node):
+        kind, column = node[0], node[1]
+        if column not in self.data.columns:
+            raise QueryError(f"Unknown column {column!r}")
+        values = self.data[column]
+        if kind == "na":
+            return values.isna().to_numpy()
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            return self.numeric_mask(node)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Evaluate the condition once per category and look the rows up by their codes
+            categories = values.cat.categories
+            if (numbers := category_numbers(categories)) is not None:
+                category_mask = number_mask(numbers, node)
+            else:
+                category_mask = text_mask(pd.Series(categories.astype(str)), node)
+            codes = values.cat.codes.to_numpy()
+            return np.append(category_mask, False)[codes]
+        return text_mask(values.astype(str).where(values.notna()), node)
+
+    def numeric_mask(self, node):
+        kind, column = node[0], node[1]
+        order, sorted_values = self.sorted_index(column)
+        bounds = [numeric_value(column, v) for v in (node[2] if kind == "in" else node[2:] if kind == "between"
+                                                        else node[3:])]
+        if np.issubdtype(sorted_values.dtype, np.floating):
+            # Compare in the column's precision, so float32 values equal the numbers they were parsed from
+            bounds = list(np.asarray(bounds, dtype=sorted_values.dtype))
+
+        def search(bound, side):
+            return np.searchsorted(sorted_values, bound, side=side)
+
+        if kind == "in":
+            ranges = [(search(bound, "left"), search(bound, "right")) for bound in bounds]
+        elif kind == "between":
+            ranges = [(search(bounds[0], "left"), search(bounds[1], "right"))]
+        else:
+            operator, bound = node[2], bounds[0]
+            ranges = {"==": [(search(bound, "left"), search(bound, "right"))],
+                      "!=": [(0, search(bound, "left")), (search(bound, "right"), len(sorted_values))],
+                      "<": [(0, search(bound, "left"))],
+                      "<=": [(0, search(bound, "right"))],
+                      ">": [(search(bound, "right"), len(sorted_values))],
+                      ">=": [(search(bound, "left"), len(sorted_values))]}[operator]
+
+        mask = np.zeros(len(self.data), dtype=bool)
+        for start, stop in ranges:
+            mask[order[start:stop]] = True
+        return mask
+
+    def sorted_index(self, column):
+        """
+        Row positions of a numeric column's values in ascending order and the sorted values, leaving out missing
+        values. Built on first use
+        """
+        if column not in self.sorted_indexes:
+            values = self.data[column].to_numpy()
+            if not np.issubdtype(values.dtype, np.number):
+                values = self.data[column].to_numpy(dtype="float64", na_value=np.nan)
+            order = np.argsort(values, kind="stable")
+            sorted_values = values[order]
+            if np.issubdtype(values.dtype, np.floating):
+                valid = np.searchsorted(np.isnan(sorted_values), True)
+                order, sorted_values = order[:valid], sorted_values[:valid]
+            self.sorted_indexes[column] = order, sorted_values
+        return self.sorted_indexes[column]
+
+
+def numeric_value(column, value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise QueryError(f"Column {column!r} is numeric, but {value!r} is not a number") from None
+
+
+def category_numbers(categories: pd.Index):
+    """
+    Categories as float64 if every one is a number, e.g. codes stored as text, otherwise None
+    """
+    if pd.api.types.is_bool_dtype(categories):
+        return None
+    if pd.api.types.is_numeric_dtype(categories):
+        return categories.to_numpy(dtype="float64")
+    numbers = pd.to_numeric(pd.Series(categories.astype(str)), errors="coerce").to_numpy(dtype="float64")
+    return numbers if len(numbers) > 0 and not np.isnan(numbers).any() else None
+
+
+def number_mask(numbers: np.ndarray, node):
+    """
+    Evaluate a condition on a small array of numbers, e.g. the categories of a column
+    """
+    kind, column = node[0], node[1]
+    if kind == "in":
+        return np.isin(numbers, [numeric_value(column, v) for v in node[2]])
+    if kind == "between":
+        return (numbers >= numeric_value(column, node[2])) & (numbers <= numeric_value(column, node[3]))
+    operator, value = node[2], numeric_value(column, node[3])
+    return {"==": numbers == value, "!=": numbers != value, "<": numbers < value, "<=": numbers <= value,
+            ">": numbers > value, ">=": numbers >= value}[operator]
+
+
+def text_mask(values: pd.Series, node):
+    """
+    Evaluate a condition on text values, comparing numbers by their text (e.g. 2 matches "2"). Text is not ordered
+    like numbers (e.g. "10" < "3"), so ordering text against a number is an error
+    """
+    kind = node[0]
+    if ((kind == "between" and any(isinstance(v, float) for v in node[2:]))
+            or (kind == "compare" and node[2] not in ["==", "!="] and isinstance(node[3], float))):
+        raise QueryError(f"Column {node[1]!r} is text, so it cannot be ordered against a number")
+
+    def text(value):
+        return format_number(value) if isinstance(value, float) else value
+
+    present = values.notna().to_numpy()
+    if kind == "in":
+        return values.isin([text(v) for v in node[2]]).to_numpy() & present
+    if kind == "between":
+        return ((values >= text(node[2])) & (values <= text(node[3]))).fillna(False).to_numpy(dtype=bool) & present
+    operator, value = node[2], text(node[3])
+    result = {"==": values == value, "!=": values != value, "<": values < value, "<=": values <= value,
+              ">": values > value, ">=": values >= value}[operator]
+    return result.fillna(False).to_numpy(dtype=bool) & present
+
+
+def format_number(value):
+    return str(int(value)) if float(value).is_integer() else str(value)
@@ -0,0 +1,21 @@
+import pandas as pd
+import pytest
+
+import copdgene_data
+
+
+@pytest.fixture
+def na_file(tmp_path):
+    # The second chunk of two rows has no values in n or b
+    path = tmp_path / "subjects.txt"
+    path.write_text("sid\tn\tb\n10001A\t1\tTrue\n10002B\t2\tFalse\n10003C\t\t\n10004D\t\t\n")
+    return path
+
+
+@pytest.mark.parametrize("chunksize", [1, 2, 3, 10])
+def test_read_subject_table_chunk_without_values(na_file, chunksize):
+    data = pd.concat(copdgene_data.read_subject_table(na_file, chunksize=chunksize), ignore_index=True)
+    expected = copdgene_data.compact_dtypes(pd.read_csv(na_file, sep="\t", low_memory=False))
+    assert data.dtypes.to_dict() == expected.dtypes.to_dict()
+    assert data["n"].tolist()[:2] == [1, 2] and data["n"].isna().tolist() == [False, False, True, True]
+    assert data["b"].tolist()[:2] == [True, False] and data["b"].isna().tolist() == [False, False, True, True]
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import subject_query
+
+
+@pytest.fixture
+def engine():
+    data = pd.DataFrame({"ci": pd.Categorical([1, 2, None, 10]),
+                         "cf": pd.Categorical([1.0, 2.0, None, 10.0]),
+                         "cs": pd.Categorical(["1", "2", None, "10"]),
+                         "t": pd.Categorical(["a", "b", None, "c"]),
+                         "s": pd.Series(["a", "b", None, "10"], dtype="str")})
+    return subject_query.QueryEngine(data)
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("ci < 3", [True, True, False, False]),
+    ("ci >= 3", [False, False, False, True]),
+    ("cf == 2", [False, True, False, False]),
+    ("cf in (1, 10)", [True, False, False, True]),
+    ("cs between 2 and 10", [False, True, False, True]),
+    ("cs > 3", [False, False, False, True]),
+    ("t == a", [True, False, False, False]),
+    ("s == 10", [False, False, False, True]),
+])
+def test_categorical_numbers(engine, expression, expected):
+    assert engine.mask(expression).tolist() == expected
+
+
+@pytest.mark.parametrize("expression", ["t < 3", "t between 1 and 2", "s >= 10"])
+def test_text_ordered_against_number(engine, expression):
+    with pytest.raises(subject_query.QueryError):
+        engine.mask(expression)
+
+
+@pytest.mark.parametrize("expression, expected", [
+    ("x == 1", [True, False, False]),
+    ("x != 1", [False, True, False]),
+    ("not x == 1", [False, True, False]),
+    ("x < 2", [True, False, False]),
+    ("not x < 2", [False, True, False]),
+    ("x in (1)", [True, False, False]),
+    ("x not in (1)", [False, True, False]),
+    ("x between 0 and 1", [True, False, False]),
+    ("x not between 0 and 1", [False, True, False]),
+    ("x is na", [False, False, True]),
+    ("x is not na", [True, True, False]),
+    ("not x is na", [True, True, False]),
+    ("not not x == 1", [True, False, False]),
+    ("not (x == 1 or y == a)", [False, True, False]),
+    ("not (x == 1 and y == a)", [False, True, False]),
+    ("t == a", [True, False, False]),
+    ("t != a", [False, True, False]),
+    ("not t == a", [False, True, False]),
+    ("t not in (a)", [False, True, False]),
+])
+def test_missing_values(expression, expected):
+    data = pd.DataFrame({"x": [1.0, 2.0, np.nan], "y": pd.Categorical(["a", "b", "a"]),
+                         "t": pd.Series(["a", "b", None], dtype="str")})
+    assert subject_query.QueryEngine(data).mask(expression).tolist() == expected